@@ -0,0 +1,537 @@
+import os
+import re
+import sys
+import ssl
+import json
+import time
+import types
+import asyncio
+import argparse
+import datetime
+import resource
+import tempfile
+import threading
+import statistics
+from email.utils import formatdate
+
+# Benchmark offline: lokalny serwer HTTPS udaje Xiaomi (logowanie, probe tokenów, bl-auth),
+# atrapa Bot API liczy wywołania, a "północ" jest za kilkadziesiąt sekund.
+# Nic nie wychodzi do prawdziwych serwerów Xiaomi ani Telegrama.
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+UNLOCK_PATH = "/bbs/api/global/apply/bl-auth"
+PROBE_PATH = "/bbs/api/global/user/bl-switch/state"
+LOGIN_PATH = "/bbs/api/global/user/login-in"
+
+LOGIN_PAGE = b"""<!DOCTYPE html>
+<html><body>
+<form method="post" action="/login">
+<input name="account"><input name="password" type="password">
+<button type="submit">Sign in</button>
+</form>
+</body></html>"""
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Offline benchmark of token fetching, unlock timing and Telegram load")
+    parser.add_argument("--users", type=int, default=20, help="auto unlock users in the simulated night")
+    parser.add_argument("--manual-users", type=int, default=5, help="concurrent /manual_unlock runs after the night")
+    parser.add_argument("--lead", type=float, default=30.0, help="seconds from start to the simulated 00:00")
+    parser.add_argument("--login-mode", choices=("simulated", "browser"), default="simulated",
+                        help="simulated: sleep instead of a browser login; browser: real Playwright against the stand-in")
+    parser.add_argument("--login-delay", type=float, default=2.0, help="seconds per simulated login")
+    parser.add_argument("--bot-latency-ms", type=float, default=40.0, help="latency of the fake Bot API")
+    parser.add_argument("--burst-offsets-ms", default="0", help="UNLOCK_BURST_OFFSETS_MS for the run")
+    parser.add_argument("--json", dest="json_path", help="also write the results as JSON to this file")
+    return parser.parse_args()
+
+
+def configure_environment(args, workdir):
+    # Ustawiamy przed importem modułów bota - config czyta zmienne przy imporcie
+    os.environ["USER_DB_PATH"] = os.path.join(workdir, "users.db")
+    os.environ["UNLOCK_BURST_OFFSETS_MS"] = args.burst_offsets_ms
+    os.environ["CLOCK_SYNC_SAMPLES"] = "3"
+    if args.login_mode == "simulated":
+        os.environ["TOKEN_WORKER_PROCESSES"] = "0"
+    os.chdir(workdir)
+    sys.path.insert(0, REPO_DIR)
+
+
+def make_certificate(workdir, host):
+    from cryptography import x509
+    from cryptography.x509.oid import NameOID
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import rsa
+    import ipaddress
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, host)])
+    now = datetime.datetime.now(datetime.timezone.utc)
+    cert = (
+        x509.CertificateBuilder()
+        .subject_name(name).issuer_name(name)
+        .public_key(key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(now - datetime.timedelta(days=1))
+        .not_valid_after(now + datetime.timedelta(days=1))
+        .add_extension(x509.SubjectAlternativeName([
+            x509.DNSName(host), x509.IPAddress(ipaddress.ip_address("127.0.0.1")),
+        ]), critical=False)
+        .add_extension(x509.BasicConstraints(ca=True, path_length=None), critical=True)
+        .sign(key, hashes.SHA256())
+    )
+    cert_path = os.path.join(workdir, "standin.pem")
+    key_path = os.path.join(workdir, "standin.key")
+    with open(cert_path, "wb") as f:
+        f.write(cert.public_bytes(serialization.Encoding.PEM))
+    with open(key_path, "wb") as f:
+        f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.TraditionalOpenSSL,
+                                  serialization.NoEncryption()))
+    return cert_path, key_path
+
+
+class StandInServer:
+    # Serwer HTTPS w osobnym wątku (własna pętla), żeby obsługa zapytań nie zakłócała pętli bota
+    def __init__(self, cert_path, key_path):
+        self.ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+        self.ssl_context.load_cert_chain(cert_path, key_path)
+        self.arrivals = []   # (time.time() przyjścia, token bbs z ciasteczka)
+        self.requests = {}   # ścieżka -> liczba zapytań
+        self.port = None
+        self._loop = None
+        self._stopped = None
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._serve, daemon=True)
+
+    def start(self):
+        self._thread.start()
+        self._ready.wait()
+        return self.port
+
+    def stop(self):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stopped.set)
+            self._thread.join(timeout=5)
+
+    def _serve(self):
+        self._loop = asyncio.new_event_loop()
+        self._loop.run_until_complete(self._main())
+        self._loop.close()
+
+    async def _main(self):
+        self._stopped = asyncio.Event()
+        server = await asyncio.start_server(self._handle, "127.0.0.1", 0, ssl=self.ssl_context)
+        self.port = server.sockets[0].getsockname()[1]
+        self._ready.set()
+        await self._stopped.wait()
+        server.close()
+        handlers = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+        for task in handlers:
+            task.cancel()
+        await asyncio.gather(*handlers, return_exceptions=True)
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                arrived_at = time.time()
+                method, target, _ = request_line.decode("latin-1").split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", "0") or 0))
+                path = target.split("?", 1)[0]
+                self.requests[path] = self.requests.get(path, 0) + 1
+                status, extra_headers, payload = self._route(method, path, headers, body, arrived_at)
+                self._respond(writer, method, status, extra_headers, payload)
+                await writer.drain()
+                if headers.get("connection", "").lower() == "close":
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError, ValueError, ssl.SSLError):
+            pass
+        finally:
+            writer.close()
+
+    def _route(self, method, path, headers, body, arrived_at):
+        json_headers = [("Content-Type", "application/json")]
+        if path == UNLOCK_PATH and method == "POST":
+            match = re.search(r"new_bbs_serviceToken=([^;]*)", headers.get("cookie", ""))
+            self.arrivals.append((arrived_at, match.group(1) if match else None))
+            return 200, json_headers, b'{"code":0,"data":{"apply_result":1}}'
+        if path == PROBE_PATH:
+            return 200, json_headers, b'{"code":0,"data":{}}'
+        if path == LOGIN_PATH:
+            return 200, [("Content-Type", "text/html")], LOGIN_PAGE
+        if path == "/login" and method == "POST":
+            form = dict(part.split("=", 1) for part in body.decode().split("&") if "=" in part)
+            account = form.get("account", "unknown")
+            return 200, [
+                ("Content-Type", "text/html"),
+                ("Set-Cookie", f"new_bbs_serviceToken=bench-bbs-{account}; Path=/"),
+                ("Set-Cookie", f"popRunToken=bench-pop-{account}; Path=/"),
+            ], b"<html><body>ok</body></html>"
+        return 200, [("Content-Type", "text/plain")], b""
+
+    @staticmethod
+    def _respond(writer, method, status, extra_headers, payload):
+        lines = [f"HTTP/1.1 {status} OK", f"Date: {formatdate(usegmt=True)}", f"Content-Length: {len(payload)}"]
+        lines += [f"{name}: {value}" for name, value in extra_headers]
+        writer.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        if method != "HEAD":
+            writer.write(payload)
+
+
+class FakeBot:
+    # Atrapa Bot API: liczy wywołania i symuluje opóźnienie sieci
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.calls = {"send_message": 0, "edit_message_text": 0}
+        self._message_ids = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.calls["send_message"] += 1
+        await asyncio.sleep(self.latency)
+        self._message_ids += 1
+        return types.SimpleNamespace(message_id=self._message_ids, chat_id=chat_id)
+
+    async def edit_message_text(self, text, chat_id=None, message_id=None, **kwargs):
+        self.calls["edit_message_text"] += 1
+        await asyncio.sleep(self.latency)
+        return True
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+
+class LoopMonitor:
+    # Opóźnienie pętli zdarzeń (spóźnienie krótkiego sleep) i szczytowe RSS procesu
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.lags = []       # (time.time(), opóźnienie w sekundach)
+        self.peak_rss_kb = 0
+        self._task = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+
+    async def _run(self):
+        ticks = 0
+        while True:
+            expected = time.perf_counter() + self.interval
+            await asyncio.sleep(self.interval)
+            self.lags.append((time.time(), max(0.0, time.perf_counter() - expected)))
+            ticks += 1
+            if ticks % 20 == 0:
+                self.peak_rss_kb = max(self.peak_rss_kb, current_rss_kb())
+
+    def lag_between(self, start: float, end: float):
+        return [lag for ts, lag in self.lags if start <= ts <= end]
+
+
+def current_rss_kb():
+    try:
+        with open("/proc/self/status", "r", encoding="ascii") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return 0
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+def summarize_ms(values):
+    if not values:
+        return None
+    return {
+        "count": len(values),
+        "min": min(values) * 1000,
+        "median": statistics.median(values) * 1000,
+        "p95": percentile(values, 0.95) * 1000,
+        "max": max(values) * 1000,
+    }
+
+
+def format_ms(summary, signed: bool = False):
+    if summary is None:
+        return "n/a"
+    fmt = "+.2f" if signed else ".2f"
+    return (f"min {summary['min']:{fmt}} / median {summary['median']:{fmt}} / p95 {summary['p95']:{fmt}} / "
+            f"max {summary['max']:{fmt}} ms (n={summary['count']})")
+
+
+def patch_for_standin(args, port, cert_path):
+    # Kierujemy sesję Xiaomi, pomiar opóźnień i logowanie na lokalny serwer
+    from config import MI_SERVER_DOMAIN
+    import http_session
+    import latency_probe
+    import workers
+    from browser_pool import BROWSER_POOL
+
+    session = http_session.HTTP11Session(MI_SERVER_DOMAIN, port=port)
+    session._ssl_context = ssl.create_default_context(cafile=cert_path)
+    session.pin_addresses(["127.0.0.1"])
+    # Domena Xiaomi "rozwiązuje się" na stand-in na stałe - bez zapytań do DNS
+    session._resolved = ["127.0.0.1"]
+    session._resolved_at = float("inf")
+    http_session.SESSIONS[MI_SERVER_DOMAIN] = session
+
+    async def local_probe(max_age=None):
+        result = latency_probe.ServerLatency("127.0.0.1")
+        start = time.perf_counter()
+        _, writer = await asyncio.open_connection("127.0.0.1", port)
+        result.tcp_ms = (time.perf_counter() - start) * 1000
+        writer.close()
+        result.tls_ms = result.tcp_ms
+        return latency_probe.ProbeResult([result], time.time())
+
+    latency_probe.LATENCY_PROBE.get = local_probe
+
+    if args.login_mode == "browser":
+        workers.LOGIN_URL = f"https://127.0.0.1:{port}{LOGIN_PATH}"
+        BROWSER_POOL.context_options = {"ignore_https_errors": True}
+    return session
+
+
+def instrument_fetches(args):
+    # Mierzymy czas każdego pobrania tokenów; w trybie simulated logowanie zastępuje sleep
+    import workers
+    from token_cache import save_tokens
+
+    timings = []
+    original = workers.FETCH_SCHEDULER.fetch_func
+
+    async def simulated_login(user_id, email, password):
+        await asyncio.sleep(args.login_delay)
+        tokens = {"new_bbs_serviceToken": f"bench-bbs-{email}", "popRunToken": f"bench-pop-{email}"}
+        return tokens if save_tokens(user_id, tokens) else None
+
+    fetch = simulated_login if args.login_mode == "simulated" else original
+
+    async def timed_fetch(user_id, email, password):
+        start = time.time()
+        try:
+            return await fetch(user_id, email, password)
+        finally:
+            timings.append((start, time.time()))
+
+    workers.FETCH_SCHEDULER.fetch_func = timed_fetch
+    return timings
+
+
+def fetch_summary(timings):
+    if not timings:
+        return None
+    wall = max(end for _, end in timings) - min(start for start, _ in timings)
+    return {
+        "fetches": len(timings),
+        "wall_seconds": wall,
+        "per_minute": len(timings) / wall * 60 if wall > 0 else None,
+        "duration": summarize_ms([end - start for start, end in timings]),
+    }
+
+
+async def run_night(args, standin, bot, monitor):
+    import unlock_scheduler
+    from user_store import USER_STORE
+    from outbox import OUTBOX
+
+    # Symulowana północ za args.lead sekund, fazy nocy ściśnięte proporcjonalnie
+    midnight = datetime.datetime.now(unlock_scheduler.TZ_CHINA) + datetime.timedelta(seconds=args.lead)
+    unlock_scheduler.next_midnight_china = lambda: midnight
+    unlock_scheduler.TOKEN_FETCH_WINDOW = args.lead - 1
+    unlock_scheduler.TOKEN_FETCH_MARGIN = min(unlock_scheduler.TOKEN_FETCH_MARGIN, args.lead * 0.2)
+    unlock_scheduler.CLOCK_SYNC_LEAD = min(unlock_scheduler.CLOCK_SYNC_LEAD, args.lead * 0.4)
+    unlock_scheduler.HTTP_WARMUP_LEAD = min(unlock_scheduler.HTTP_WARMUP_LEAD, args.lead * 0.15)
+
+    bursts = []
+    done = asyncio.Event()
+    original_fire_burst = unlock_scheduler.fire_burst
+
+    async def recording_fire_burst(session, timer, shots, is_definitive):
+        try:
+            return await original_fire_burst(session, timer, shots, is_definitive)
+        finally:
+            bursts.append((timer, list(shots)))
+            if len(bursts) == args.users:
+                done.set()
+
+    unlock_scheduler.fire_burst = recording_fire_burst
+
+    user_ids = list(range(1, args.users + 1))
+    for user_id in user_ids:
+        USER_STORE.authorize(user_id, "en")
+        await unlock_scheduler.start_auto_unlock_for_user(
+            user_id, {"email": f"user{user_id}", "password": "secret"}, bot
+        )
+
+    try:
+        await asyncio.wait_for(done.wait(), args.lead + 60)
+    except asyncio.TimeoutError:
+        print(f"[Warning] Only {len(bursts)} of {args.users} users fired before the timeout")
+    await asyncio.sleep(1.0)
+    for user_id in user_ids:
+        unlock_scheduler.stop_auto_unlock(user_id)
+    await drain_outbox(OUTBOX)
+
+    # Dopasowanie przyjść na serwerze do strzałów po tokenie z ciasteczka
+    arrivals = {}
+    for arrived_at, token in standin.arrivals:
+        arrivals.setdefault(token, []).append(arrived_at)
+    server_jitter, client_jitter = [], []
+    target_ts = None
+    for timer, shots in bursts:
+        target_ts = timer.target_ts
+        sent = sorted((shot for shot in shots if shot.sent), key=lambda shot: shot.offset)
+        for shot in sent:
+            error = shot.timing_error(timer)
+            if error is not None:
+                client_jitter.append(error)
+        for shot in sent:
+            match = re.search(rb"new_bbs_serviceToken=([^;]*)", shot.prepared.payload)
+            token = match.group(1).decode() if match else None
+            times = arrivals.get(token)
+            if times:
+                server_jitter.append(times.pop(0) - (timer.target_ts + shot.offset))
+
+    window_lag = monitor.lag_between(target_ts - 2, target_ts + 1) if target_ts else []
+    return {
+        "users": args.users,
+        "users_fired": len(bursts),
+        "shot_arrival_vs_deadline": summarize_ms(server_jitter),
+        "shot_send_vs_deadline": summarize_ms(client_jitter),
+        "loop_lag_around_deadline": summarize_ms(window_lag),
+    }
+
+
+async def run_manual(args, bot):
+    import workers
+    from user_store import USER_STORE
+    from outbox import OUTBOX
+
+    first_id = args.users + 1
+    user_ids = list(range(first_id, first_id + args.manual_users))
+    for user_id in user_ids:
+        USER_STORE.authorize(user_id, "en")
+
+    async def one(user_id):
+        start = time.perf_counter()
+        await workers.manual_unlock(user_id, {"email": f"user{user_id}", "password": "secret"}, bot)
+        return time.perf_counter() - start
+
+    durations = await asyncio.gather(*(one(user_id) for user_id in user_ids))
+    await drain_outbox(OUTBOX)
+    return {"runs": len(durations), "duration": summarize_ms(list(durations))}
+
+
+async def drain_outbox(outbox, timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    while outbox.pending() and time.monotonic() < deadline:
+        await asyncio.sleep(0.1)
+    await asyncio.sleep(0.5)  # ostatnie wysyłki w locie
+
+
+async def run(args, workdir):
+    from config import MI_SERVER_DOMAIN
+
+    cert_path, key_path = make_certificate(workdir, MI_SERVER_DOMAIN)
+    standin = StandInServer(cert_path, key_path)
+    port = standin.start()
+    patch_for_standin(args, port, cert_path)
+    fetch_timings = instrument_fetches(args)
+
+    bot = FakeBot(args.bot_latency_ms / 1000)
+    monitor = LoopMonitor()
+    monitor.start()
+    started = time.time()
+    results = {"config": vars(args)}
+    try:
+        night_start = time.time()
+        results["night"] = await run_night(args, standin, bot, monitor)
+        results["night"]["bot_api_calls"] = bot.total_calls()
+        results["night"]["token_fetch"] = fetch_summary(fetch_timings)
+        results["night"]["loop_lag"] = summarize_ms(monitor.lag_between(night_start, time.time()))
+
+        calls_before = bot.total_calls()
+        fetches_before = len(fetch_timings)
+        manual_start = time.time()
+        if args.manual_users > 0:
+            results["manual"] = await run_manual(args, bot)
+            results["manual"]["bot_api_calls"] = bot.total_calls() - calls_before
+            results["manual"]["token_fetch"] = fetch_summary(fetch_timings[fetches_before:])
+            results["manual"]["loop_lag"] = summarize_ms(monitor.lag_between(manual_start, time.time()))
+    finally:
+        monitor.stop()
+        standin.stop()
+        from browser_pool import BROWSER_POOL
+        await BROWSER_POOL.close()
+
+    results["elapsed_seconds"] = time.time() - started
+    results["memory"] = {
+        "peak_rss_mb": max(monitor.peak_rss_kb, current_rss_kb()) / 1024,
+        "max_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "max_child_rss_mb": resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    }
+    results["standin_requests"] = dict(standin.requests)
+    return results
+
+
+def print_report(results):
+    night = results["night"]
+    print()
+    print(f"=== Simulated night: {night['users_fired']}/{night['users']} users fired ===")
+    fetch = night.get("token_fetch")
+    if fetch:
+        print(f"Token fetches:          {fetch['fetches']} in {fetch['wall_seconds']:.1f} s "
+              f"({fetch['per_minute']:.1f}/min), per fetch {format_ms(fetch['duration'])}")
+    print(f"Shot arrival vs target: {format_ms(night['shot_arrival_vs_deadline'], signed=True)}")
+    print(f"Shot send vs target:    {format_ms(night['shot_send_vs_deadline'], signed=True)}")
+    print(f"Loop lag near target:   {format_ms(night['loop_lag_around_deadline'])}")
+    print(f"Loop lag whole night:   {format_ms(night['loop_lag'])}")
+    print(f"Bot API calls:          {night['bot_api_calls']} ({night['bot_api_calls'] / max(1, night['users']):.1f} per user)")
+
+    manual = results.get("manual")
+    if manual:
+        print(f"=== Manual unlock: {manual['runs']} concurrent runs ===")
+        print(f"Duration:               {format_ms(manual['duration'])}")
+        print(f"Loop lag:               {format_ms(manual['loop_lag'])}")
+        print(f"Bot API calls:          {manual['bot_api_calls']}")
+
+    memory = results["memory"]
+    print(f"=== Memory: peak RSS {memory['peak_rss_mb']:.1f} MB, "
+          f"largest child process {memory['max_child_rss_mb']:.1f} MB ===")
+    print(f"Stand-in requests: {results['standin_requests']}")
+
+
+def main():
+    args = parse_args()
+    if args.json_path:
+        args.json_path = os.path.abspath(args.json_path)
+    workdir = tempfile.mkdtemp(prefix="unlocker-bench-")
+    configure_environment(args, workdir)
+    results = asyncio.run(run(args, workdir))
+    print_report(results)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2, default=str)
+        print(f"Results written to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,9 +1,9 @@
 import os
-import json
 import base64
 from dotenv import load_dotenv
 from cryptography.fernet import Fernet
 import asyncio
+from functools import partial
 from datetime import datetime, timedelta
 import pytz
 import shutil
@@ -23,13 +23,24 @@ def generate_random_accesscode(length=8):
 
 from workers import (
     manual_unlock,
+    test_tokens,
+)
+from unlock_scheduler import (
     start_auto_unlock_for_user,
     stop_auto_unlock,
     is_auto_unlock_running,
-    test_tokens,
 )
+from browser_pool import BROWSER_POOL
+from token_workers import TOKEN_WORKERS
+from config import DATA_DIR, ADMIN_IDS
+from token_cache import invalidate_tokens
+from user_store import USER_STORE
+from credential_cache import CREDENTIAL_CACHE
+from update_processor import PerUserUpdateProcessor
+from outbox import OUTBOX, PRIORITY_CHATTER
+from metrics import METRICS, METRICS_SERVER, format_summary
+from firing_offset import FIRING_OFFSETS, MIN_LEARNED_SAMPLES
 
-DATA_DIR = "data"
 os.makedirs(DATA_DIR, exist_ok=True)
 
 load_dotenv()
@@ -64,41 +75,42 @@ fernet = Fernet(FERNET_KEY)
 SETUP_LOGIN, SETUP_PASSWORD = range(2)
 
 def user_dir_path(user_id):
+    # Stary układ danych (sprzed bazy SQLite), używany tylko przy usuwaniu danych
     return os.path.join(DATA_DIR, f"{user_id}")
 
 def is_user_authorized(user_id):
-    return os.path.isdir(user_dir_path(user_id))
+    return USER_STORE.is_authorized(user_id)
 
-def create_user_folder(user_id):
-    path = user_dir_path(user_id)
-    os.makedirs(path, exist_ok=True)
-
-def credentials_path(user_id):
-    return os.path.join(user_dir_path(user_id), "credentials.json")
+def authorize_user(user_id, language=None):
+    USER_STORE.authorize(user_id, language)
 
 def save_credentials(user_id, login_encrypted, password_encrypted):
-    data = {
-        "email": login_encrypted.decode(),
-        "password": password_encrypted.decode()
-    }
-    with open(credentials_path(user_id), "w", encoding="utf-8") as f:
-        json.dump(data, f, indent=2)
+    CREDENTIAL_CACHE.invalidate(user_id)
+    USER_STORE.save_credentials(user_id, login_encrypted.decode(), password_encrypted.decode())
 
-def load_credentials(user_id):
+def decrypt_credentials(login_encrypted, pwd_encrypted):
     try:
-        with open(credentials_path(user_id), "r", encoding="utf-8") as f:
-            data = json.load(f)
-            login_encrypted = data.get("email", "").encode()
-            pwd_encrypted = data.get("password", "").encode()
-            login = fernet.decrypt(login_encrypted).decode()
-            password = fernet.decrypt(pwd_encrypted).decode()
-            return {
-                "email": login,
-                "password": password
-            }
+        login = fernet.decrypt(login_encrypted.encode()).decode()
+        password = fernet.decrypt(pwd_encrypted.encode()).decode()
+        return {
+            "email": login,
+            "password": password
+        }
     except Exception:
         return None
 
+def load_credentials(user_id):
+    user_data = CREDENTIAL_CACHE.get(user_id)
+    if user_data:
+        return user_data
+    row = USER_STORE.load_credentials(user_id)
+    if row is None:
+        return None
+    user_data = decrypt_credentials(*row)
+    if user_data:
+        CREDENTIAL_CACHE.put(user_id, user_data)
+    return user_data
+
 def language_is_english(update: Update):
     lang = update.effective_user.language_code
     return lang is not None and lang.startswith("en")
@@ -136,7 +148,8 @@ async def accesscode(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     code = args[0]
     if code == ACCESS_CODE:
-        create_user_folder(user_id)
+        # Język zapamiętujemy, żeby po restarcie nie pytać Telegrama (get_chat)
+        authorize_user(user_id, update.effective_user.language_code)
         await send_text(update,
             "Kod poprawny, masz dostęp do dalszych komend.",
             "Access code accepted, you can use other commands now."
@@ -186,6 +199,8 @@ async def setup_password(update: Update, context: ContextTypes.DEFAULT_TYPE):
     login_encrypted = fernet.encrypt(login.encode())
     password_encrypted = fernet.encrypt(password.encode())
     save_credentials(user_id, login_encrypted, password_encrypted)
+    # Stare tokeny należą do poprzedniego konta
+    invalidate_tokens(user_id)
     try:
         await update.message.delete()
     except:
@@ -262,9 +277,7 @@ async def auto_unlock_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     # Zapisujemy status
-    status_path = os.path.join(user_dir_path(user_id), "status")
-    with open(status_path, "w", encoding="utf-8") as f:
-        f.write("autounlock")
+    USER_STORE.set_status(user_id, "autounlock")
 
     tz_china = "Asia/Shanghai"
     from datetime import datetime, timezone
@@ -308,9 +321,7 @@ async def auto_unlock_stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     stop_auto_unlock(user_id)
 
     # Usuwamy status
-    status_path = os.path.join(user_dir_path(user_id), "status")
-    if os.path.exists(status_path):
-        os.remove(status_path)
+    USER_STORE.set_status(user_id, None)
 
     await send_text(update,
         "Auto unlock zatrzymany.",
@@ -363,18 +374,23 @@ async def test_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def clear_user_data(user_id):
     if is_auto_unlock_running(user_id):
         stop_auto_unlock(user_id)
+    invalidate_tokens(user_id)
+    CREDENTIAL_CACHE.invalidate(user_id)
 
+    # Kopia danych ze starego układu katalogów (zostaje po migracji) też musi zniknąć
     path = user_dir_path(user_id)
-    if os.path.exists(path) and os.path.isdir(path):
+    if os.path.isdir(path):
         try:
             shutil.rmtree(path)
-            print(f"Usunięto folder użytkownika {user_id}: {path}")
-            return True
+            print(f"Usunięto stary folder użytkownika {user_id}: {path}")
         except Exception as e:
             print(f"Błąd przy usuwaniu folderu {path}: {e}")
-            return False
-    else:
-        print(f"Folder użytkownika {user_id} nie istnieje: {path}")
+
+    USER_STORE.delete_shots(user_id)
+    if USER_STORE.delete_user(user_id):
+        print(f"Usunięto dane użytkownika {user_id}")
+        return True
+    print(f"Użytkownik {user_id} nie istnieje w bazie")
     return False
 
 async def clear_data_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -400,6 +416,64 @@ async def clear_data_command(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
 
 
+# --- komendy administratorów ---
+async def require_admin(update: Update):
+    if update.effective_user.id in ADMIN_IDS:
+        return True
+    await send_text(update,
+        "Nieznana komenda. Użyj /help.",
+        "Unknown command. Use /help."
+    )
+    return False
+
+# --- /stats (tylko administratorzy) ---
+async def stats_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await require_admin(update):
+        return
+
+    lines = ["Phase timings since start (count × mean / p95 / max):"]
+    lines += format_summary(METRICS.snapshot()) or ["no data yet"]
+    for night, summary in USER_STORE.recent_night_summaries(3):
+        lines.append("")
+        lines.append(f"Night {night}: {summary.get('users', 0)} users, "
+                     f"{summary.get('failed_bursts', 0)} failed bursts")
+        lines += format_summary(summary.get("spans", {}))
+
+    text = "\n".join(lines)
+    if len(text) > 4096:
+        text = text[:4095] + "…"
+    await update.message.reply_text(text)
+
+# --- /offsets (tylko administratorzy) ---
+async def offsets_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    if not await require_admin(update):
+        return
+
+    state = "on" if FIRING_OFFSETS.enabled else "off"
+    lines = [f"Learned firing offsets (learning {state}, bound ±{FIRING_OFFSETS.bound * 1000:.0f} ms, "
+             f"used after {MIN_LEARNED_SAMPLES} nights, "
+             f"early codes: {', '.join(map(str, sorted(FIRING_OFFSETS.early_codes))) or 'none'}):"]
+    servers = FIRING_OFFSETS.snapshot()
+    for server in servers:
+        updated = datetime.fromtimestamp(server.updated_at).strftime("%Y-%m-%d %H:%M") if server.updated_at else "-"
+        lines.append(f"{server.server}: {server.firing_offset * 1000:+.1f} ms, {server.samples} nights, "
+                     f"last {server.last_outcome or '-'} ({updated})")
+    if not servers:
+        lines.append("no data yet, using ping / 2")
+
+    since = (datetime.now() - timedelta(days=30)).strftime("%Y-%m-%d")
+    counts = USER_STORE.shot_outcome_counts(since)
+    if counts:
+        lines.append("")
+        lines.append("Shots in the last 30 nights (server: code / apply_result × count):")
+        for server, code, apply_result, count in counts:
+            lines.append(f"{server or '-'}: {code} / {apply_result} × {count}")
+
+    text = "\n".join(lines)
+    if len(text) > 4096:
+        text = text[:4095] + "…"
+    await update.message.reply_text(text)
+
 # --- /help ---
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await send_text(update,
@@ -458,48 +532,41 @@ async def resume_all_auto_unlocks(app):
     time_str = f"{hours} godz. {minutes} min. {seconds} sek."
     time_str_en = f"{hours}h {minutes}m {seconds}s"
 
-    for user_id_str in os.listdir(DATA_DIR):
-        if not user_id_str.isdigit():
-            continue
-        user_id = int(user_id_str)
-        user_data = load_credentials(user_id)
+    # Najpierw planujemy wszystkich (bez sieci), powiadomienia idą w tle, żeby nie blokować startu bota
+    notifications = []
+    for user_id, login_encrypted, pwd_encrypted, lang in USER_STORE.users_with_status("autounlock"):
+        user_data = CREDENTIAL_CACHE.get(user_id) or decrypt_credentials(login_encrypted, pwd_encrypted)
         if not user_data:
             continue
-        status_path = os.path.join(user_dir_path(user_id), "status")
-        if os.path.exists(status_path):
-            with open(status_path, "r", encoding="utf-8") as f:
-                status = f.read().strip()
-            if status == "autounlock":
-                from workers import is_auto_unlock_running, start_auto_unlock_for_user
-                if not is_auto_unlock_running(user_id):
-                    print(f"Wznawiam auto unlock dla user {user_id}")
-                    await start_auto_unlock_for_user(user_id, user_data, app.bot)
-
-                    # Pobierz info o użytkowniku z Telegrama
-                    try:
-                        user = await app.bot.get_chat(user_id)
-                        lang = user.language_code or "pl"
-                    except Exception:
-                        lang = "pl"  # domyślnie polski jeśli błąd
-
-                    if lang.startswith("en"):
-                        message = (
-                            f"Auto unlock resumed after bot restart.\n"
-                            f"Auto unlock is active and waiting for 00:00 China time.\n"
-                            f"Time remaining: {time_str_en}"
-                        )
-                    else:
-                        message = (
-                            f"Wznowiono auto unlock po restarcie bota.\n"
-                            f"Auto unlock działa i czeka na 00:00 czasu chińskiego.\n"
-                            f"Pozostały czas: {time_str}"
-                        )
-                    try:
-                        await app.bot.send_message(chat_id=user_id, text=message)
-                    except Exception as e:
-                        print(f"Failed to send resume message to {user_id}: {e}")
+        CREDENTIAL_CACHE.put(user_id, user_data)
+        if is_auto_unlock_running(user_id):
+            continue
+        print(f"Wznawiam auto unlock dla user {user_id}")
+        await start_auto_unlock_for_user(user_id, user_data, app.bot)
+
+        if (lang or "pl").startswith("en"):
+            message = (
+                f"Auto unlock resumed after bot restart.\n"
+                f"Auto unlock is active and waiting for 00:00 China time.\n"
+                f"Time remaining: {time_str_en}"
+            )
+        else:
+            message = (
+                f"Wznowiono auto unlock po restarcie bota.\n"
+                f"Auto unlock działa i czeka na 00:00 czasu chińskiego.\n"
+                f"Pozostały czas: {time_str}"
+            )
+        notifications.append((user_id, message))
+
+    # Powiadomienia idą przez kolejkę w tle, za wynikami i postępem unlocków
+    for user_id, message in notifications:
+        OUTBOX.submit(partial(app.bot.send_message, chat_id=user_id, text=message), PRIORITY_CHATTER,
+                      description=f"resume message for {user_id}")
+    if notifications:
+        print(f"Wznowiono auto unlock dla {len(notifications)} użytkowników")
+
 async def main():
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    app = ApplicationBuilder().token(BOT_TOKEN).concurrent_updates(PerUserUpdateProcessor()).build()
 
     conv_handler = ConversationHandler(
         entry_points=[CommandHandler('setup', setup_start)],
@@ -520,6 +587,8 @@ async def main():
 
     app.add_handler(CommandHandler("test", test_command))
     app.add_handler(CommandHandler("clear_data", clear_data_command))
+    app.add_handler(CommandHandler("stats", stats_command))
+    app.add_handler(CommandHandler("offsets", offsets_command))
 
     app.add_handler(CommandHandler("help", help_cmd))
     app.add_handler(CommandHandler("cancel", cancel))
@@ -529,8 +598,16 @@ async def main():
 
     # Wznawiamy auto_unlock po restarcie
     await resume_all_auto_unlocks(app)
+    await METRICS_SERVER.start()
 
-    await app.run_polling()
+    try:
+        await app.run_polling()
+    finally:
+        await BROWSER_POOL.close()
+        await TOKEN_WORKERS.close()
+        await METRICS_SERVER.close()
+        USER_STORE.close()
+        CREDENTIAL_CACHE.clear()
 
 if __name__ == "__main__":
     import nest_asyncio
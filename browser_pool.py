@@ -0,0 +1,114 @@
+import asyncio
+
+from playwright.async_api import async_playwright
+
+from config import BROWSER_POOL_SIZE, BROWSER_MAX_USES
+from metrics import METRICS
+
+ENGINES = ("firefox", "chromium")
+
+
+class BrowserSlot:
+    def __init__(self, engine: str, index: int, max_uses: int):
+        self.engine = engine
+        self.index = index
+        self.max_uses = max_uses
+        self.browser = None
+        self.uses = 0
+
+    async def _launch(self, playwright):
+        with METRICS.span("browser_launch", engine=self.engine):
+            self.browser = await getattr(playwright, self.engine).launch(headless=True)
+        self.uses = 0
+        print(f"[Info] Launched {self.engine} browser (slot {self.index})")
+
+    async def _close_browser(self):
+        if self.browser is not None:
+            try:
+                await self.browser.close()
+            except Exception as e:
+                print(f"[Error] Closing {self.engine} browser (slot {self.index}) failed: {e}")
+            self.browser = None
+
+    def _is_healthy(self):
+        return self.browser is not None and self.browser.is_connected()
+
+    async def run_job(self, playwright, job, context_options=None):
+        if self.uses >= self.max_uses:
+            print(f"[Info] Recycling {self.engine} browser (slot {self.index}) after {self.uses} uses")
+            await self._close_browser()
+        if not self._is_healthy():
+            await self._close_browser()
+            await self._launch(playwright)
+
+        context = await self.browser.new_context(**(context_options or {}))
+        try:
+            return await job(context)
+        finally:
+            self.uses += 1
+            try:
+                await context.close()
+            except Exception:
+                # Kontekst nie da się zamknąć - przeglądarka najpewniej padła
+                await self._close_browser()
+
+
+class BrowserPool:
+    # Wszystkie przeglądarki są sterowane z pętli zdarzeń bota przez jeden driver async Playwright
+    def __init__(self, size: int = BROWSER_POOL_SIZE, max_uses: int = BROWSER_MAX_USES, context_options: dict = None):
+        self.size = size
+        self.max_uses = max_uses
+        self.context_options = context_options or {}  # argumenty new_context() (np. w benchmarku)
+        self._playwright_cm = None
+        self._playwright = None
+        self._start_lock = None
+        self._slots = {}  # engine -> [BrowserSlot]
+        self._free = {}   # engine -> asyncio.Queue wolnych slotów
+
+    async def _get_playwright(self):
+        if self._start_lock is None:
+            self._start_lock = asyncio.Lock()
+        async with self._start_lock:
+            if self._playwright is None:
+                self._playwright_cm = async_playwright()
+                self._playwright = await self._playwright_cm.start()
+        return self._playwright
+
+    def _free_slots(self, engine: str):
+        if engine not in ENGINES:
+            raise ValueError(f"Unsupported browser engine: {engine}")
+        if engine not in self._free:
+            slots = [BrowserSlot(engine, i, self.max_uses) for i in range(self.size)]
+            queue = asyncio.Queue()
+            for slot in slots:
+                queue.put_nowait(slot)
+            self._slots[engine] = slots
+            self._free[engine] = queue
+        return self._free[engine]
+
+    async def run(self, engine: str, job):
+        # job(context) to korutyna dostająca świeży, izolowany BrowserContext
+        playwright = await self._get_playwright()
+        queue = self._free_slots(engine)
+        slot = await queue.get()
+        try:
+            return await slot.run_job(playwright, job, self.context_options)
+        finally:
+            queue.put_nowait(slot)
+
+    async def close(self):
+        for slots in self._slots.values():
+            for slot in slots:
+                await slot._close_browser()
+        self._slots.clear()
+        self._free.clear()
+        if self._playwright is not None:
+            try:
+                await self._playwright.stop()
+            except Exception:
+                pass
+            self._playwright = None
+            self._playwright_cm = None
+
+
+BROWSER_POOL = BrowserPool()
@@ -0,0 +1,83 @@
+import asyncio
+
+
+class Shot:
+    def __init__(self, index: int, offset: float, prepared):
+        self.index = index
+        self.offset = offset      # sekundy względem celu (ujemne = przed 00:00)
+        self.prepared = prepared
+        self.conn = None
+        self.response = None
+        self.error = None
+        self.sent = False
+        self._read = None
+
+    def timing_error(self, timer):
+        # Ile sekund po swoim zaplanowanym momencie strzał faktycznie wyszedł
+        if self.prepared.sent_perf is None:
+            return None
+        return timer.error_of(self.prepared.sent_perf) - self.offset
+
+
+async def checkout_connections(session, shots):
+    results = await asyncio.gather(*(session.checkout() for _ in shots), return_exceptions=True)
+    for shot, result in zip(shots, results):
+        if isinstance(result, BaseException):
+            print(f"[ERROR] Could not get a connection for shot {shot.index}: {result!r}")
+        else:
+            shot.conn = result
+
+
+def _first_definitive(shots, is_definitive):
+    for shot in shots:
+        if shot._read is not None and shot._read.done() and shot.response is not None:
+            if is_definitive(shot.response):
+                return shot
+    return None
+
+
+async def fire_burst(session, timer, shots, is_definitive):
+    # Strzały wychodzą kolejno o (cel + offset) na osobnych połączeniach, odpowiedzi czytamy równolegle.
+    # Gdy któraś odpowiedź jest rozstrzygająca, kolejne strzały nie są już wysyłane.
+    shots = sorted(shots, key=lambda s: s.offset)
+
+    def read_done(shot):
+        def callback(future):
+            if future.cancelled():
+                return
+            if future.exception() is not None:
+                shot.error = future.exception()
+            else:
+                shot.response = future.result()
+        return callback
+
+    for shot in shots:
+        await timer.wait(lead=-shot.offset)
+        if _first_definitive(shots, is_definitive) is not None:
+            break
+
+        try:
+            if shot.conn is None:
+                shot.conn = await session.checkout()
+            session.send(shot.prepared, shot.conn)
+        except Exception as e:
+            # Połączenie padło tuż przed strzałem - jedna próba na świeżym
+            print(f"[ERROR] Shot {shot.index} failed ({e}), retrying on a new connection")
+            try:
+                shot.conn = await session.checkout()
+                session.send(shot.prepared, shot.conn)
+            except Exception as e:
+                shot.error = e
+                continue
+        shot.sent = True
+        shot._read = asyncio.create_task(session.read_response(shot.prepared, shot.conn))
+        shot._read.add_done_callback(read_done(shot))
+
+    reads = [shot._read for shot in shots if shot._read is not None]
+    if reads:
+        await asyncio.gather(*reads, return_exceptions=True)
+    for shot in shots:
+        if not shot.sent and shot.conn is not None:
+            session.release(shot.conn)
+
+    return shots, _first_definitive(shots, is_definitive)
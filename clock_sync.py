@@ -0,0 +1,99 @@
+import time
+import asyncio
+import statistics
+from email.utils import parsedate_to_datetime
+
+from config import MI_SERVER_DOMAIN, CLOCK_SYNC_SAMPLES, CLOCK_SYNC_TTL
+from http_session import get_session
+from metrics import METRICS
+
+MAX_TRUSTED_OFFSET = 60.0  # większy rozjazd traktujemy jako błąd pomiaru, nie zegara
+
+
+class ClockSyncResult:
+    def __init__(self, offset: float, uncertainty: float, rtt: float, samples: int, measured_at: float):
+        self.offset = offset            # czas serwera - czas lokalny (sekundy)
+        self.uncertainty = uncertainty  # połowa szerokości przedziału (sekundy)
+        self.rtt = rtt                  # najkrótszy zmierzony RTT (sekundy)
+        self.samples = samples
+        self.measured_at = measured_at
+
+
+async def take_sample(session):
+    # Zwraca (t0, t1, czas serwera z nagłówka Date) albo None
+    t0 = time.time()
+    response = await session.make_request("HEAD", f"https://{session.host}/")
+    t1 = time.time()
+    if response is None:
+        return None
+    date_header = response.headers.get("Date")
+    if not date_header:
+        return None
+    try:
+        server_ts = parsedate_to_datetime(date_header).timestamp()
+    except (TypeError, ValueError):
+        return None
+    return t0, t1, server_ts
+
+
+def estimate_offset(samples):
+    # Nagłówek Date ma rozdzielczość 1 s: serwer w chwili z [t0, t1] miał czas z [S, S+1),
+    # więc offset leży w [S - t1, S + 1 - t0]. Przecinamy przedziały wszystkich próbek.
+    low = max(s - t1 for t0, t1, s in samples)
+    high = min(s + 1 - t0 for t0, t1, s in samples)
+    rtt = min(t1 - t0 for t0, t1, s in samples)
+    if low <= high:
+        return (low + high) / 2, (high - low) / 2, rtt
+    # Przedziały się nie przecinają (np. zmiana zegara w trakcie) - mediana środków
+    mids = [s + 0.5 - (t0 + t1) / 2 for t0, t1, s in samples]
+    return statistics.median(mids), 0.5 + rtt / 2, rtt
+
+
+class ClockSync:
+    # Jeden wspólny pomiar przesunięcia zegara serwera Xiaomi dla wszystkich użytkowników
+    def __init__(self, host: str = MI_SERVER_DOMAIN, samples: int = CLOCK_SYNC_SAMPLES, ttl: float = CLOCK_SYNC_TTL):
+        self.host = host
+        self.samples = samples
+        self.ttl = ttl
+        self._result = None
+        self._task = None
+
+    async def _measure(self):
+        with METRICS.span("clock_sync"):
+            return await self._collect()
+
+    async def _collect(self):
+        session = get_session(self.host)
+        collected = []
+        for i in range(self.samples):
+            sample = await take_sample(session)
+            if sample is not None:
+                collected.append(sample)
+            if i + 1 < self.samples:
+                # Odstęp nie jest wielokrotnością sekundy, żeby próbki trafiały w różne fazy sekundy serwera
+                await asyncio.sleep(1 + 1 / self.samples)
+
+        if not collected:
+            print(f"[Error] Clock sync with {self.host} failed: no Date samples")
+            return None
+        offset, uncertainty, rtt = estimate_offset(collected)
+        if abs(offset) > MAX_TRUSTED_OFFSET:
+            print(f"[Warning] Ignoring implausible clock offset {offset:+.3f} s from {self.host}")
+            return None
+        print(f"[Info] Clock offset vs {self.host}: {offset * 1000:+.1f} ms "
+              f"(±{uncertainty * 1000:.1f} ms, rtt {rtt * 1000:.1f} ms, {len(collected)} samples)")
+        return ClockSyncResult(offset, uncertainty, rtt, len(collected), time.time())
+
+    async def get(self):
+        # Zwraca ClockSyncResult albo None; równoległe wywołania czekają na ten sam pomiar
+        if self._result is not None and time.time() - self._result.measured_at < self.ttl:
+            return self._result
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._measure())
+        result = await asyncio.shield(self._task)
+        if result is not None:
+            self._result = result
+        return result
+
+
+CLOCK_SYNC = ClockSync()
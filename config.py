@@ -0,0 +1,125 @@
+import os
+from dotenv import load_dotenv
+
+load_dotenv()
+
+
+def env_int(name: str, default: int):
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        print(f"[Warning] Invalid value for {name}: {value!r}, using default {default}")
+        return default
+
+
+def env_float(name: str, default: float):
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return float(value)
+    except ValueError:
+        print(f"[Warning] Invalid value for {name}: {value!r}, using default {default}")
+        return default
+
+
+DATA_DIR = "data"
+
+MI_SERVERS = ['161.117.96.161', '20.157.18.26']
+MI_SERVER_DOMAIN = 'sgp-api.buy.mi.com'
+
+def env_float_list(name: str, default: list):
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return [float(item) for item in value.split(",") if item.strip()]
+    except ValueError:
+        print(f"[Warning] Invalid value for {name}: {value!r}, using default {default}")
+        return default
+
+
+def env_int_list(name: str, default: list):
+    value = os.getenv(name)
+    if value is None or value.strip() == "":
+        return default
+    try:
+        return [int(item) for item in value.split(",") if item.strip()]
+    except ValueError:
+        print(f"[Warning] Invalid value for {name}: {value!r}, using default {default}")
+        return default
+
+
+# Pula przeglądarek dla Playwright
+BROWSER_POOL_SIZE = max(1, env_int("BROWSER_POOL_SIZE", 2))    # przeglądarki na silnik (firefox / chromium)
+BROWSER_MAX_USES = max(1, env_int("BROWSER_MAX_USES", 25))     # po tylu loginach przeglądarka jest restartowana
+
+# Oczekiwanie na ciasteczka z tokenami po kliknięciu "zaloguj"
+TOKEN_WAIT_TIMEOUT = max(1.0, env_float("TOKEN_WAIT_TIMEOUT", 10.0))     # sekundy
+TOKEN_POLL_INTERVAL = max(0.05, env_float("TOKEN_POLL_INTERVAL", 0.25))  # sekundy
+
+# Cache tokenów - po tym czasie tokeny są zawsze pobierane ponownie przez przeglądarkę
+TOKEN_CACHE_TTL = max(0, env_int("TOKEN_CACHE_TTL", 6 * 3600))  # sekundy
+
+# Okno pobierania tokenów przed północą (auto unlock)
+TOKEN_FETCH_WINDOW = max(60, env_int("TOKEN_FETCH_WINDOW", 15 * 60))  # sekundy przed 00:00 gdy zaczynamy
+TOKEN_FETCH_MARGIN = max(0, env_int("TOKEN_FETCH_MARGIN", 60))        # tokeny mają być gotowe tyle sekund przed 00:00
+MAX_CONCURRENT_BROWSERS = max(2, env_int("MAX_CONCURRENT_BROWSERS", 2 * BROWSER_POOL_SIZE))
+FETCH_MEMORY_BUDGET_MB = max(0, env_int("FETCH_MEMORY_BUDGET_MB", 0))  # 0 = według wolnej pamięci systemu
+FETCH_MEMORY_PER_JOB_MB = max(1, env_int("FETCH_MEMORY_PER_JOB_MB", 400))
+
+# Współdzielone połączenia HTTPS do API Xiaomi
+HTTP_POOL_MAX_SIZE = max(1, env_int("HTTP_POOL_MAX_SIZE", 32))
+HTTP_WARMUP_LEAD = max(1, env_int("HTTP_WARMUP_LEAD", 60))                 # sekundy przed strzałem
+HTTP_KEEPALIVE_INTERVAL = max(1.0, env_float("HTTP_KEEPALIVE_INTERVAL", 15.0))  # sekundy
+
+# Synchronizacja z zegarem serwera Xiaomi (nagłówek Date)
+CLOCK_SYNC_SAMPLES = max(1, env_int("CLOCK_SYNC_SAMPLES", 8))
+CLOCK_SYNC_LEAD = max(HTTP_WARMUP_LEAD, env_int("CLOCK_SYNC_LEAD", 120))  # sekundy przed 00:00
+CLOCK_SYNC_TTL = max(0, env_int("CLOCK_SYNC_TTL", 300))                  # sekundy ważności pomiaru
+
+# Seria strzałów wokół 00:00 - przesunięcia w milisekundach, np. "-20,0,15,40"; domyślnie jeden strzał
+UNLOCK_BURST_OFFSETS = sorted(offset / 1000 for offset in env_float_list("UNLOCK_BURST_OFFSETS_MS", [0.0])) or [0.0]
+
+# Pomiar opóźnień do serwerów Xiaomi
+LATENCY_PROBE_COUNT = max(1, env_int("LATENCY_PROBE_COUNT", 3))
+LATENCY_PROBE_TTL = max(0, env_int("LATENCY_PROBE_TTL", 30))  # sekundy ważności wspólnego pomiaru
+
+# Procesy robocze do logowania w przeglądarkach (0 = przeglądarki w procesie bota)
+TOKEN_WORKER_PROCESSES = max(0, env_int("TOKEN_WORKER_PROCESSES", 0))
+TOKEN_JOB_TIMEOUT = max(1, env_int("TOKEN_JOB_TIMEOUT", 120))  # sekundy na jedno logowanie w procesie roboczym
+
+# Baza użytkowników (SQLite); stare katalogi data/<user_id>/ są importowane jednorazowo
+USER_DB_PATH = os.getenv("USER_DB_PATH", os.path.join(DATA_DIR, "users.db"))
+
+# Pamięć podręczna odszyfrowanych danych logowania (0 = wyłączona)
+CREDENTIAL_CACHE_SIZE = max(0, env_int("CREDENTIAL_CACHE_SIZE", 256))  # użytkowników
+CREDENTIAL_CACHE_TTL = max(0, env_int("CREDENTIAL_CACHE_TTL", 600))  # sekundy
+
+# Handlery komend wykonywane równolegle (różni użytkownicy; jeden użytkownik zawsze po kolei)
+UPDATE_CONCURRENCY = max(1, env_int("UPDATE_CONCURRENCY", 16))
+
+# Statusy auto/manual unlock: jedna edytowana wiadomość; pierwszy status cyklu idzie od razu,
+# kolejne czekają na wynik albo najwyżej tyle sekund (dłużej niż okno pobierania tokenów)
+STATUS_DEBOUNCE = max(0.0, env_float("STATUS_DEBOUNCE", 1800.0))
+
+# Kolejka wiadomości do Telegrama (w tle, z priorytetami)
+OUTBOX_RATE = max(0.1, env_float("OUTBOX_RATE", 25.0))  # wiadomości (i edycji) na sekundę
+OUTBOX_CONCURRENCY = max(1, env_int("OUTBOX_CONCURRENCY", 8))
+OUTBOX_MAX_PENDING = max(1, env_int("OUTBOX_MAX_PENDING", 5000))  # powyżej odrzucamy najmniej ważne
+
+# Metryki czasów faz: endpoint Prometheusa (0 = wyłączony) i administratorzy komendy /stats
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = max(0, env_int("METRICS_PORT", 0))
+ADMIN_IDS = set(env_int_list("ADMIN_IDS", []))  # identyfikatory Telegram, oddzielone przecinkami
+
+# Offset strzału uczony per serwer Xiaomi z wyników poprzednich nocy (apply_result), w granicach ±BOUND
+FIRING_OFFSET_LEARNING = env_int("FIRING_OFFSET_LEARNING", 1) != 0
+FIRING_OFFSET_RATE = min(1.0, max(0.0, env_float("FIRING_OFFSET_RATE", 0.3)))  # waga ostatniego udanego strzału
+FIRING_OFFSET_STEP = max(0.0, env_float("FIRING_OFFSET_STEP_MS", 10.0)) / 1000   # krok po zbyt późnym / wczesnym strzale
+FIRING_OFFSET_BOUND = max(0.0, env_float("FIRING_OFFSET_BOUND_MS", 250.0)) / 1000
+# Kody odpowiedzi oznaczające "jeszcze przed czasem"; inne błędy (np. wygasłe tokeny) nie uczą offsetu
+FIRING_OFFSET_EARLY_CODES = frozenset(env_int_list("FIRING_OFFSET_EARLY_CODES", []))
@@ -0,0 +1,67 @@
+import time
+import threading
+from collections import OrderedDict
+
+from config import CREDENTIAL_CACHE_SIZE, CREDENTIAL_CACHE_TTL
+
+
+def wipe(buffer: bytearray):
+    # Nadpisujemy zerami; kopie str przekazane wcześniej wywołującym zostają (best effort)
+    for i in range(len(buffer)):
+        buffer[i] = 0
+
+
+class CredentialCache:
+    # Odszyfrowane dane logowania w pamięci (LRU + TTL), żeby nie czytać bazy i nie deszyfrować co komendę
+    def __init__(self, max_size: int = CREDENTIAL_CACHE_SIZE, ttl: float = CREDENTIAL_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()  # user_id -> (email, password, expires_at), sekrety jako bytearray
+        self._lock = threading.Lock()
+
+    def enabled(self):
+        return self.max_size > 0 and self.ttl > 0
+
+    def get(self, user_id: int):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            email, password, expires_at = entry
+            if time.monotonic() >= expires_at:
+                self._evict(user_id)
+                return None
+            self._entries.move_to_end(user_id)
+            return {"email": email.decode(), "password": password.decode()}
+
+    def put(self, user_id: int, user_data: dict):
+        if not self.enabled():
+            return
+        entry = (
+            bytearray(user_data["email"].encode()),
+            bytearray(user_data["password"].encode()),
+            time.monotonic() + self.ttl,
+        )
+        with self._lock:
+            self._evict(user_id)
+            self._entries[user_id] = entry
+            while len(self._entries) > self.max_size:
+                self._evict(next(iter(self._entries)))
+
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._evict(user_id)
+
+    def clear(self):
+        with self._lock:
+            for user_id in list(self._entries):
+                self._evict(user_id)
+
+    def _evict(self, user_id: int):
+        entry = self._entries.pop(user_id, None)
+        if entry is not None:
+            wipe(entry[0])
+            wipe(entry[1])
+
+
+CREDENTIAL_CACHE = CredentialCache()
@@ -0,0 +1,50 @@
+import time
+import asyncio
+
+COARSE_RECHECK_INTERVAL = 60.0  # długi sen dzielimy na odcinki i za każdym razem liczymy od nowa
+FINE_MARGIN = 0.050             # ostatnie 50 ms śpimy krótkimi odcinkami
+SPIN_MARGIN = 0.002             # ostatnie 2 ms kręcimy się na perf_counter
+CLOCK_JUMP_WARNING = 0.5        # sekundy rozjazdu zegara ściennego względem monotonicznego
+
+
+class DeadlineTimer:
+    # Cel podajemy jako czas unixowy, ale odliczamy na perf_counter (monotoniczny),
+    # więc skoki zegara systemowego w trakcie nocnego czekania nie przesuwają strzału.
+    def __init__(self, target_ts: float):
+        self.target_ts = target_ts
+        self.target_perf = time.perf_counter() + (target_ts - time.time())
+
+    def remaining(self):
+        return self.target_perf - time.perf_counter()
+
+    def _check_wall_clock(self):
+        wall_remaining = self.target_ts - time.time()
+        drift = wall_remaining - self.remaining()
+        if abs(drift) > CLOCK_JUMP_WARNING:
+            print(f"[Warning] System clock moved by {drift:+.3f} s while waiting, keeping monotonic deadline")
+
+    async def wait(self, lead: float = 0.0):
+        # Czeka do (cel - lead); zwraca błąd osiągnięty względem tego momentu w sekundach (+ = spóźnienie)
+        target_perf = self.target_perf - lead
+
+        while True:
+            remaining = target_perf - time.perf_counter()
+            if remaining <= FINE_MARGIN:
+                break
+            await asyncio.sleep(min(remaining - FINE_MARGIN, COARSE_RECHECK_INTERVAL))
+            self._check_wall_clock()
+
+        while True:
+            remaining = target_perf - time.perf_counter()
+            if remaining <= SPIN_MARGIN:
+                break
+            await asyncio.sleep(remaining - SPIN_MARGIN)
+
+        while time.perf_counter() < target_perf:
+            pass
+
+        return time.perf_counter() - target_perf
+
+    def error_of(self, perf_timestamp: float):
+        # Różnica między zmierzonym momentem (perf_counter) a celem
+        return perf_timestamp - self.target_perf
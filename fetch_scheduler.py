@@ -0,0 +1,94 @@
+import time
+import heapq
+import asyncio
+import itertools
+
+from config import MAX_CONCURRENT_BROWSERS, FETCH_MEMORY_BUDGET_MB, FETCH_MEMORY_PER_JOB_MB
+
+BROWSERS_PER_FETCH = 2  # firefox + chromium
+
+
+def available_memory_mb():
+    # Linux: MemAvailable z /proc/meminfo, na innych systemach brak limitu
+    try:
+        with open("/proc/meminfo", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+class TokenFetchScheduler:
+    # Kolejka pobierania tokenów: najwcześniejszy deadline pierwszy (EDF),
+    # z limitem równoległych przeglądarek i budżetem pamięci.
+    def __init__(self, fetch_func, max_browsers: int = MAX_CONCURRENT_BROWSERS,
+                 memory_budget_mb: int = FETCH_MEMORY_BUDGET_MB,
+                 memory_per_job_mb: int = FETCH_MEMORY_PER_JOB_MB):
+        self.fetch_func = fetch_func
+        self.max_jobs = max(1, max_browsers // BROWSERS_PER_FETCH)
+        self.memory_budget_mb = memory_budget_mb
+        self.memory_per_job_mb = memory_per_job_mb
+        self._queue = []  # (deadline, seq, user_id, email, password, future)
+        self._seq = itertools.count()
+        self._running = 0
+        self._wakeup = None
+        self._dispatcher = None
+
+    def pending(self):
+        return len(self._queue)
+
+    def running(self):
+        return self._running
+
+    async def fetch(self, user_id: int, email: str, password: str, deadline: float = None):
+        # deadline to czas unixowy, do którego tokeny muszą być gotowe; None = jak najszybciej
+        if deadline is None:
+            deadline = time.time()
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        heapq.heappush(self._queue, (deadline, next(self._seq), user_id, email, password, future))
+        self._ensure_dispatcher()
+        self._wakeup.set()
+        return await future
+
+    def _ensure_dispatcher(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch_loop())
+
+    def _can_admit(self):
+        if self._running == 0:
+            return True  # zawsze pozwalamy na co najmniej jedno pobieranie
+        if self._running >= self.max_jobs:
+            return False
+        if self.memory_budget_mb > 0:
+            return (self._running + 1) * self.memory_per_job_mb <= self.memory_budget_mb
+        free_mb = available_memory_mb()
+        return free_mb is None or free_mb >= self.memory_per_job_mb
+
+    async def _dispatch_loop(self):
+        while True:
+            while self._queue and self._can_admit():
+                deadline, _, user_id, email, password, future = heapq.heappop(self._queue)
+                if future.done():
+                    continue  # wywołujący zrezygnował
+                self._running += 1
+                asyncio.create_task(self._run(user_id, email, password, future))
+            self._wakeup.clear()
+            await self._wakeup.wait()
+
+    async def _run(self, user_id: int, email: str, password: str, future):
+        try:
+            tokens = await self.fetch_func(user_id, email, password)
+            if not future.done():
+                future.set_result(tokens)
+        except Exception as e:
+            print(f"[Error] Token fetch for user {user_id} failed: {e}")
+            if not future.done():
+                future.set_exception(e)
+        finally:
+            self._running -= 1
+            self._wakeup.set()
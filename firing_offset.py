@@ -0,0 +1,101 @@
+import time
+
+from config import (
+    FIRING_OFFSET_LEARNING, FIRING_OFFSET_RATE, FIRING_OFFSET_STEP, FIRING_OFFSET_BOUND, FIRING_OFFSET_EARLY_CODES,
+)
+from user_store import USER_STORE
+
+MIN_LEARNED_SAMPLES = 3  # tyle rozstrzygających nocy, zanim wyuczony offset zastąpi połowę pingu
+
+APPLY_ACCEPTED = 1       # prośba przyjęta - strzał był na czas
+APPLY_LIMIT_REACHED = 3  # limit wyczerpany: po 00:00 serwera za późno, przed 00:00 - limit poprzedniego dnia
+
+
+class ServerOffset:
+    def __init__(self, server: str, firing_offset: float, samples: int = 0,
+                 last_outcome: str = None, updated_at: float = None):
+        self.server = server
+        self.firing_offset = firing_offset  # sekundy względem 00:00 czasu serwera (ujemne = przed północą)
+        self.samples = samples
+        self.last_outcome = last_outcome
+        self.updated_at = updated_at
+
+
+class FiringOffsets:
+    # Offset strzału per serwer Xiaomi uczony z wyników kolejnych nocy:
+    # przyjęta prośba przyciąga offset do czasu tego strzału, apply_result 3 strzału, który doszedł po północy
+    # serwera (za późno) przesuwa go wcześniej, a apply_result 3 albo kod z early_codes strzału, który doszedł
+    # przed północą (za wcześnie) - później.
+    # Wynik zawsze w ±bound.
+    def __init__(self, store=USER_STORE, enabled: bool = FIRING_OFFSET_LEARNING, rate: float = FIRING_OFFSET_RATE,
+                 step: float = FIRING_OFFSET_STEP, bound: float = FIRING_OFFSET_BOUND,
+                 early_codes: frozenset = FIRING_OFFSET_EARLY_CODES):
+        self.store = store
+        self.enabled = enabled
+        self.rate = rate
+        self.step = step
+        self.bound = bound
+        self.early_codes = early_codes
+        self._servers = None  # server -> ServerOffset, ładowane z bazy przy pierwszym użyciu
+
+    def _load(self):
+        if self._servers is None:
+            self._servers = {row[0]: ServerOffset(*row) for row in self.store.load_server_offsets()}
+        return self._servers
+
+    def _clamp(self, value: float):
+        return min(self.bound, max(-self.bound, value))
+
+    def offset_for(self, server: str, fallback: float):
+        # Zwraca (offset w sekundach, czy wyuczony); bez wystarczającej historii - fallback (połowa pingu)
+        if not self.enabled or server is None:
+            return fallback, False
+        state = self._load().get(server)
+        if state is None or state.samples < MIN_LEARNED_SAMPLES:
+            return fallback, False
+        return self._clamp(state.firing_offset), True
+
+    def learn(self, server: str, outcomes: list, applied: float):
+        # outcomes: (send_delta, shift, rtt_ms, code, apply_result) strzałów jednej nocy na ten serwer,
+        # send_delta = moment wysłania względem 00:00 czasu serwera, shift = o ile strzał faktycznie
+        # wyszedł od środka serii (przesunięcie w serii + opóźnienie wysyłki), rtt_ms = pomiar z fazy probe
+        # (None = brak); applied = offset użyty tej nocy.
+        # Uczymy się środka serii (send_delta - shift), bo to on jest przesuwany offsetem - inaczej
+        # przyjęty strzał z ujemnym przesunięciem albo stałe opóźnienie wysyłki co noc przesuwałyby środek.
+        accepted, late, early = [], [], []
+        for delta, shift, rtt_ms, code, result in outcomes:
+            center = delta - shift
+            arrival = delta + (rtt_ms or 0.0) / 2000  # szacowane dojście do serwera względem 00:00
+            if code == 0 and result == APPLY_ACCEPTED:
+                accepted.append(center)
+            elif code == 0 and result == APPLY_LIMIT_REACHED:
+                (late if arrival >= 0 else early).append(center)
+            elif code in self.early_codes and arrival < 0:
+                early.append(center)
+
+        servers = self._load()
+        state = servers.get(server)
+        estimate = state.firing_offset if state is not None else applied
+        if accepted:
+            estimate += self.rate * (min(accepted) - estimate)
+            outcome = "accepted"
+        elif late:
+            estimate = min(estimate, min(late)) - self.step
+            outcome = "too late"
+        elif early:
+            estimate = max(estimate, max(early)) + self.step
+            outcome = "too early"
+        else:
+            return None  # brak rozstrzygającego wyniku (blokada konta, błędy) - nic się nie uczymy
+
+        samples = state.samples + 1 if state is not None else 1
+        state = ServerOffset(server, self._clamp(estimate), samples, outcome, time.time())
+        servers[server] = state
+        self.store.save_server_offset(server, state.firing_offset, state.samples, state.last_outcome)
+        return state
+
+    def snapshot(self):
+        return sorted(self._load().values(), key=lambda state: state.server)
+
+
+FIRING_OFFSETS = FiringOffsets()
@@ -0,0 +1,365 @@
+import io
+import ssl
+import time
+import zlib
+import socket
+import asyncio
+import http.client
+from collections import namedtuple
+from urllib.parse import urlsplit
+
+from config import HTTP_POOL_MAX_SIZE, HTTP_KEEPALIVE_INTERVAL
+from metrics import METRICS
+
+Response = namedtuple("Response", ["status", "headers", "data"])
+
+# Ostatnie sekundy przed strzałem nie pingujemy, żeby ping nie zajął połączenia
+KEEPALIVE_QUIET_PERIOD = 2.0
+ADDRESS_CACHE_TTL = 600.0  # sekundy ważności przypiętych / rozwiązanych adresów
+MAX_HEADER_LINES = 100
+
+
+def decode_body(data: bytes, content_encoding):
+    encoding = (content_encoding or "").lower()
+    if encoding == "gzip":
+        return zlib.decompress(data, 16 + zlib.MAX_WBITS)
+    if encoding == "deflate":
+        try:
+            return zlib.decompress(data)
+        except zlib.error:
+            return zlib.decompress(data, -zlib.MAX_WBITS)
+    return data
+
+
+async def read_http_response(reader, method: str):
+    # Minimalny parser odpowiedzi HTTP/1.1; zwraca (status, headers, body, will_close)
+    status_line = await reader.readline()
+    if not status_line:
+        raise http.client.RemoteDisconnected("Remote end closed connection without response")
+    try:
+        version, status, _ = (status_line.decode("latin-1").rstrip("\r\n") + " ").split(" ", 2)
+        status = int(status)
+    except ValueError:
+        raise http.client.BadStatusLine(status_line)
+
+    header_lines = []
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        header_lines.append(line)
+        if len(header_lines) > MAX_HEADER_LINES:
+            raise http.client.HTTPException("Too many response headers")
+    headers = http.client.parse_headers(io.BytesIO(b"".join(header_lines) + b"\r\n"))
+
+    connection = (headers.get("Connection") or "").lower()
+    will_close = connection == "close" or (version == "HTTP/1.0" and connection != "keep-alive")
+
+    if method == "HEAD" or status in (204, 304) or 100 <= status < 200:
+        body = b""
+    elif (headers.get("Transfer-Encoding") or "").lower() == "chunked":
+        chunks = []
+        while True:
+            size_line = await reader.readline()
+            size = int(size_line.split(b";", 1)[0].strip() or b"0", 16)
+            if size == 0:
+                break
+            chunks.append(await reader.readexactly(size))
+            await reader.readexactly(2)
+        # Trailery aż do pustej linii
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+            pass
+        body = b"".join(chunks)
+    elif headers.get("Content-Length") is not None:
+        body = await reader.readexactly(int(headers.get("Content-Length")))
+    else:
+        body = await reader.read()
+        will_close = True
+    return status, headers, body, will_close
+
+
+class PreparedRequest:
+    def __init__(self, method: str, payload: bytes):
+        self.method = method
+        self.payload = payload
+        self.sent_at = None    # time.time() tuż przed wysłaniem
+        self.sent_perf = None  # time.perf_counter() tuż przed wysłaniem
+
+
+class Connection:
+    def __init__(self, reader, writer, peer: str):
+        self.reader = reader
+        self.writer = writer
+        self.peer = peer
+        self.reused = False  # leżało w puli keep-alive - serwer mógł je w międzyczasie zamknąć
+
+    def is_usable(self):
+        # Pętla zdarzeń czyta gniazdo na bieżąco, więc zamknięcie przez serwer widać od razu
+        return not self.writer.is_closing() and not self.reader.at_eof()
+
+    def close(self):
+        if not self.writer.is_closing():
+            self.writer.close()
+
+
+def retry_is_safe(prepared, conn, error):
+    # Ponawiamy tylko, gdy serwer na pewno nie dostał zapytania: nic nie zostało wysłane albo
+    # połączenie z puli zamknięto bez żadnej odpowiedzi. Nigdy po timeoucie odczytu -
+    # POST bl-auth mógł już zostać przyjęty i drugi byłby kolejnym wnioskiem o odblokowanie.
+    if prepared.sent_at is None:
+        return True
+    return conn.reused and isinstance(error, http.client.RemoteDisconnected)
+
+
+class HTTP11Session:
+    # Jedna sesja na endpoint Xiaomi, współdzielona przez wszystkich użytkowników.
+    # Trzyma pulę otwartych połączeń TLS (asyncio), które można rozgrzać przed północą.
+    def __init__(self, host: str, port: int = 443, max_size: int = HTTP_POOL_MAX_SIZE,
+                 connect_timeout: float = 2.0, read_timeout: float = 15.0):
+        self.host = host
+        self.port = port
+        self.max_size = max_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._ssl_context = ssl.create_default_context()
+        self._idle = []
+        self._pinned = []
+        self._pinned_at = 0.0
+        self._resolved = []
+        self._resolved_at = 0.0
+        self._warm_target = 0
+        self._warm_until = 0.0
+        self._keepalive_task = None
+
+    def pin_addresses(self, addresses: list):
+        # Kolejność IP od najlepszego (wg pomiaru opóźnień); SNI i Host zostają ustawione na domenę
+        self._pinned = list(addresses)
+        self._pinned_at = time.time()
+        if self._pinned:
+            # Bezczynne połączenia do gorszych serwerów nie powinny obsłużyć strzału
+            keep = [conn for conn in self._idle if conn.peer == self._pinned[0]]
+            for conn in self._idle:
+                if conn not in keep:
+                    conn.close()
+            self._idle = keep
+
+    async def _resolve(self):
+        # Adresy z DNS trzymamy w pamięci, żeby o północy nie czekać na resolver
+        if time.time() - self._resolved_at < ADDRESS_CACHE_TTL:
+            return self._resolved
+        # Nieudane zapytanie też zapamiętujemy, żeby nie powtarzać go przy każdym połączeniu
+        self._resolved_at = time.time()
+        try:
+            loop = asyncio.get_running_loop()
+            infos = await loop.getaddrinfo(self.host, self.port, type=socket.SOCK_STREAM)
+            self._resolved = list(dict.fromkeys(info[4][0] for info in infos))
+        except OSError as e:
+            print(f"[ERROR] DNS lookup for {self.host} failed: {e}")
+        return self._resolved
+
+    async def _candidate_addresses(self):
+        pinned = list(self._pinned) if time.time() - self._pinned_at < ADDRESS_CACHE_TTL else []
+        return list(dict.fromkeys(pinned + await self._resolve()))
+
+    async def _connect(self, address: str):
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(address, self.port, ssl=self._ssl_context, server_hostname=self.host),
+            self.connect_timeout,
+        )
+        return Connection(reader, writer, address)
+
+    async def _new_connection(self):
+        last_error = None
+        for address in await self._candidate_addresses():
+            try:
+                return await self._connect(address)
+            except (OSError, asyncio.TimeoutError) as e:
+                print(f"[ERROR] Connection to {self.host} via {address} failed ({e!r}), trying next address")
+                last_error = e
+                # Niedziałający adres przesuwamy na koniec kolejki
+                if address in self._pinned:
+                    self._pinned.remove(address)
+                    self._pinned.append(address)
+        if last_error is not None:
+            raise last_error
+        return await self._connect(self.host)
+
+    async def _get_connection(self):
+        while self._idle:
+            conn = self._idle.pop()
+            if conn.is_usable():
+                return conn
+            conn.close()
+        return await self._new_connection()
+
+    def _put_connection(self, conn):
+        if conn.is_usable() and len(self._idle) < self.max_size:
+            conn.reused = True
+            self._idle.append(conn)
+            return
+        conn.close()
+
+    def idle_connections(self):
+        return len(self._idle)
+
+    def prepare(self, method, url, headers=None, body=None):
+        # Składa gotowe bajty zapytania HTTP/1.1, żeby w chwili strzału został tylko zapis do gniazda
+        request_headers = {"Host": self.host}
+        if headers:
+            request_headers.update(headers)
+        request_headers['Content-Type'] = 'application/json; charset=utf-8'
+
+        if method == 'POST':
+            if body is None:
+                body = '{"is_retry":true}'.encode('utf-8')
+            request_headers['Content-Length'] = str(len(body))
+            request_headers['Accept-Encoding'] = 'gzip, deflate'
+            request_headers['User-Agent'] = 'okhttp/4.12.0'
+            request_headers['Connection'] = 'keep-alive'
+        else:
+            request_headers.setdefault('Accept-Encoding', 'identity')
+
+        parts = urlsplit(url)
+        path = (parts.path or "/") + (f"?{parts.query}" if parts.query else "")
+        head = f"{method} {path} HTTP/1.1\r\n"
+        head += "".join(f"{name}: {value}\r\n" for name, value in request_headers.items())
+        head += "\r\n"
+        return PreparedRequest(method, head.encode("latin-1") + (body or b""))
+
+    async def checkout(self):
+        # Pobiera rozgrzane połączenie z puli (albo otwiera nowe) przed strzałem
+        return await self._get_connection()
+
+    def release(self, conn):
+        self._put_connection(conn)
+
+    def send(self, prepared, conn):
+        # Synchroniczny zapis gotowych bajtów - transport wysyła je od razu, bez czekania na pętlę
+        if not conn.is_usable():
+            conn.close()
+            raise ConnectionResetError(f"Connection to {conn.peer} is closed")
+        prepared.sent_at = time.time()
+        prepared.sent_perf = time.perf_counter()
+        try:
+            conn.writer.write(prepared.payload)
+        except Exception:
+            conn.close()
+            raise
+
+    async def read_response(self, prepared, conn):
+        try:
+            await asyncio.wait_for(conn.writer.drain(), self.read_timeout)
+            status, headers, data, will_close = await asyncio.wait_for(
+                read_http_response(conn.reader, prepared.method), self.read_timeout
+            )
+        except BaseException:
+            conn.close()
+            raise
+        if will_close:
+            conn.close()
+        else:
+            self._put_connection(conn)
+        data = decode_body(data, headers.get("Content-Encoding"))
+        return Response(status, headers, data)
+
+    async def fire(self, prepared, conn):
+        self.send(prepared, conn)
+        return await self.read_response(prepared, conn)
+
+    async def send_prepared(self, prepared, conn=None):
+        try:
+            if conn is None:
+                conn = await self._get_connection()
+            try:
+                return await self.fire(prepared, conn)
+            except (OSError, asyncio.IncompleteReadError, http.client.HTTPException) as e:
+                if not retry_is_safe(prepared, conn, e):
+                    raise
+                # Rozgrzane połączenie mogło zostać zamknięte tuż przed strzałem - jedna próba na nowym
+                print(f"[ERROR] Request on pooled connection failed ({e!r}), retrying on a new one")
+                return await self.fire(prepared, await self._new_connection())
+        except Exception as e:
+            print(f"[ERROR] HTTP request failed: {e!r}")
+            return None
+
+    async def make_request(self, method, url, headers=None, body=None):
+        try:
+            prepared = self.prepare(method, url, headers=headers, body=body)
+        except Exception as e:
+            print(f"[ERROR] HTTP request failed: {e!r}")
+            return None
+        with METRICS.span("http_request", method=method):
+            return await self.send_prepared(prepared)
+
+    async def warm_up(self, count: int):
+        # Otwiera brakujące połączenia, tak by w puli było co najmniej `count` gotowych
+        count = min(count, self.max_size)
+        usable = []
+        for conn in self._idle:
+            if conn.is_usable():
+                usable.append(conn)
+            else:
+                conn.close()
+        self._idle = usable
+        missing = count - len(usable)
+        if missing <= 0:
+            return 0
+
+        results = await asyncio.gather(*(self._new_connection() for _ in range(missing)), return_exceptions=True)
+        opened = 0
+        for result in results:
+            if isinstance(result, BaseException):
+                print(f"[ERROR] Warm-up connection to {self.host} failed: {result!r}")
+                continue
+            self._put_connection(result)
+            opened += 1
+        return opened
+
+    async def _ping(self, conn):
+        prepared = PreparedRequest(
+            "HEAD",
+            f"HEAD / HTTP/1.1\r\nHost: {self.host}\r\nUser-Agent: okhttp/4.12.0\r\nConnection: keep-alive\r\n\r\n".encode("latin-1"),
+        )
+        try:
+            await self.fire(prepared, conn)  # read_response odda połączenie do puli
+        except Exception:
+            pass
+
+    async def keep_alive(self):
+        # Lekkie zapytanie HEAD na każdym bezczynnym połączeniu, żeby serwer go nie zamknął
+        conns, self._idle = self._idle, []
+        await asyncio.gather(*(self._ping(conn) for conn in conns))
+
+    async def keep_warm(self, count: int, until: float):
+        # Utrzymuje `count` rozgrzanych połączeń do czasu `until` (unix); wywołania się sumują
+        self._warm_target = min(self.max_size, max(self._warm_target, count))
+        self._warm_until = max(self._warm_until, until)
+        if self._keepalive_task is None or self._keepalive_task.done():
+            self._keepalive_task = asyncio.create_task(self._keep_warm_loop())
+
+    async def _keep_warm_loop(self):
+        try:
+            while True:
+                # Tuż przed strzałem pula jest opróżniana przez fire - w okresie ciszy nie otwieramy
+                # nowych połączeń ani nie pingujemy, żeby nie konkurować ze strzałami o łącze
+                quiet_at = self._warm_until - KEEPALIVE_QUIET_PERIOD
+                if time.time() >= quiet_at:
+                    break
+                await self.warm_up(self._warm_target)
+                remaining = quiet_at - time.time()
+                if remaining <= 0:
+                    break
+                await asyncio.sleep(min(HTTP_KEEPALIVE_INTERVAL, remaining))
+                if self._warm_until - time.time() > KEEPALIVE_QUIET_PERIOD:
+                    await self.keep_alive()
+        finally:
+            self._warm_target = 0
+
+
+SESSIONS = {}  # host -> HTTP11Session
+
+
+def get_session(host: str):
+    if host not in SESSIONS:
+        SESSIONS[host] = HTTP11Session(host)
+    return SESSIONS[host]
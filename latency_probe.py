@@ -0,0 +1,114 @@
+import ssl
+import time
+import asyncio
+
+from icmplib import async_ping
+
+from config import MI_SERVERS, MI_SERVER_DOMAIN, LATENCY_PROBE_COUNT, LATENCY_PROBE_TTL
+from metrics import METRICS
+
+PROBE_TIMEOUT = 2.0
+
+
+class ServerLatency:
+    def __init__(self, ip: str):
+        self.ip = ip
+        self.icmp_ms = None  # średni RTT ICMP
+        self.tcp_ms = None   # najkrótsze nawiązanie połączenia TCP
+        self.tls_ms = None   # najkrótsze TCP + handshake TLS
+
+    @property
+    def rtt_ms(self):
+        # ICMP bywa filtrowany, wtedy RTT z połączenia TCP (jeden round-trip)
+        values = [v for v in (self.icmp_ms, self.tcp_ms) if v is not None]
+        return min(values) if values else None
+
+    def describe(self):
+        def fmt(value):
+            return f"{value:.1f}" if value is not None else "-"
+        return f"{self.ip}: icmp {fmt(self.icmp_ms)} ms, tcp {fmt(self.tcp_ms)} ms, tls {fmt(self.tls_ms)} ms"
+
+
+class ProbeResult:
+    def __init__(self, servers: list, measured_at: float):
+        self.servers = servers
+        self.measured_at = measured_at
+
+    def ranked(self):
+        alive = [s for s in self.servers if s.rtt_ms is not None]
+        return sorted(alive, key=lambda s: s.rtt_ms)
+
+    def tls_capable(self):
+        # Adresy, które obsługują TLS dla domeny Xiaomi, od najszybszego
+        return [s.ip for s in self.ranked() if s.tls_ms is not None]
+
+    def best(self):
+        ranked = self.ranked()
+        return ranked[0] if ranked else None
+
+
+async def probe_icmp(result: ServerLatency, count: int):
+    try:
+        res = await async_ping(result.ip, count=count, timeout=PROBE_TIMEOUT, interval=0.2)
+        if res.is_alive:
+            result.icmp_ms = res.avg_rtt
+    except Exception:
+        pass
+
+
+async def probe_connect(result: ServerLatency, count: int, ssl_context):
+    for _ in range(count):
+        start = time.perf_counter()
+        try:
+            _, writer = await asyncio.wait_for(asyncio.open_connection(result.ip, 443), PROBE_TIMEOUT)
+        except Exception:
+            continue
+        elapsed = (time.perf_counter() - start) * 1000
+        writer.close()
+        result.tcp_ms = elapsed if result.tcp_ms is None else min(result.tcp_ms, elapsed)
+
+    start = time.perf_counter()
+    try:
+        _, writer = await asyncio.wait_for(
+            asyncio.open_connection(result.ip, 443, ssl=ssl_context, server_hostname=MI_SERVER_DOMAIN),
+            PROBE_TIMEOUT,
+        )
+    except Exception:
+        return
+    result.tls_ms = (time.perf_counter() - start) * 1000
+    writer.close()
+
+
+class LatencyProbe:
+    # Jeden wspólny, nieblokujący pomiar wszystkich serwerów Xiaomi, ważny przez krótki czas
+    def __init__(self, servers: list = MI_SERVERS, count: int = LATENCY_PROBE_COUNT, ttl: float = LATENCY_PROBE_TTL):
+        self.servers = servers
+        self.count = count
+        self.ttl = ttl
+        self._ssl_context = ssl.create_default_context()
+        self._result = None
+        self._task = None
+
+    async def _measure(self):
+        results = [ServerLatency(ip) for ip in self.servers]
+        probes = []
+        for result in results:
+            probes.append(probe_icmp(result, self.count))
+            probes.append(probe_connect(result, self.count, self._ssl_context))
+        with METRICS.span("latency_probe"):
+            await asyncio.gather(*probes)
+        for result in results:
+            print(f"[Info] Latency {result.describe()}")
+        return ProbeResult(results, time.time())
+
+    async def get(self, max_age: float = None):
+        max_age = self.ttl if max_age is None else max_age
+        if self._result is not None and time.time() - self._result.measured_at < max_age:
+            return self._result
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._measure())
+        self._result = await asyncio.shield(self._task)
+        return self._result
+
+
+LATENCY_PROBE = LatencyProbe()
@@ -0,0 +1,186 @@
+import time
+import asyncio
+from bisect import bisect_left
+
+from config import METRICS_HOST, METRICS_PORT
+
+# Granice kubełków histogramów w sekundach (od pojedynczych ms po długie logowania)
+BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+METRIC_PREFIX = "unlocker_"
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # ostatni = powyżej największej granicy
+        self.count = 0
+        self.sum = 0.0
+        self.max = None
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = value if self.max is None else max(self.max, value)
+
+    def quantile(self, q: float):
+        # Górna granica kubełka, w którym wypada kwantyl (dla ostatniego kubełka - maksimum)
+        if self.count == 0:
+            return None
+        rank = q * self.count
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "mean": self.sum / self.count if self.count else None,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "max": self.max,
+        }
+
+
+class Span:
+    __slots__ = ("metrics", "name", "labels", "start")
+
+    def __init__(self, metrics, name: str, labels: tuple):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.start, self.labels, failed=exc_type is not None)
+        return False
+
+
+class Metrics:
+    # Czasy faz (spany) zbierane w histogramy: od startu procesu i osobno dla bieżącej nocy
+    def __init__(self):
+        self._total = {}    # (nazwa, etykiety) -> Histogram
+        self._night = {}
+        self._errors = {}   # (nazwa, etykiety) -> liczba spanów zakończonych wyjątkiem
+
+    def span(self, name: str, **labels):
+        return Span(self, name, tuple(sorted(labels.items())))
+
+    def observe(self, name: str, seconds: float, labels: tuple = (), failed: bool = False):
+        key = (name, labels)
+        for store in (self._total, self._night):
+            histogram = store.get(key)
+            if histogram is None:
+                histogram = store[key] = Histogram()
+            histogram.observe(seconds)
+        if failed:
+            self._errors[key] = self._errors.get(key, 0) + 1
+
+    @staticmethod
+    def _key_name(key):
+        name, labels = key
+        if not labels:
+            return name
+        return name + "{" + ",".join(f"{k}={v}" for k, v in labels) + "}"
+
+    def snapshot(self, night: bool = False):
+        store = self._night if night else self._total
+        return {self._key_name(key): store[key].summary() for key in sorted(store)}
+
+    def close_night(self):
+        # Podsumowanie nocy; kolejna noc zaczyna się od pustych histogramów
+        summary = self.snapshot(night=True)
+        self._night = {}
+        return summary
+
+    def render_prometheus(self):
+        lines = []
+        by_name = {}
+        for key in sorted(self._total):
+            by_name.setdefault(key[0], []).append(key)
+        for name, keys in by_name.items():
+            metric = f"{METRIC_PREFIX}{name}_seconds"
+            lines.append(f"# TYPE {metric} histogram")
+            for key in keys:
+                histogram = self._total[key]
+                labels = [f'{k}="{v}"' for k, v in key[1]]
+                cumulative = 0
+                for bound, count in zip(histogram.buckets, histogram.counts):
+                    cumulative += count
+                    bucket_labels = ",".join(labels + [f'le="{bound}"'])
+                    lines.append(f"{metric}_bucket{{{bucket_labels}}} {cumulative}")
+                bucket_labels = ",".join(labels + ['le="+Inf"'])
+                lines.append(f"{metric}_bucket{{{bucket_labels}}} {histogram.count}")
+                label_str = "{" + ",".join(labels) + "}" if labels else ""
+                lines.append(f"{metric}_sum{label_str} {histogram.sum}")
+                lines.append(f"{metric}_count{label_str} {histogram.count}")
+        if self._errors:
+            lines.append(f"# TYPE {METRIC_PREFIX}span_errors_total counter")
+            for (name, labels), count in sorted(self._errors.items()):
+                label_str = ",".join([f'span="{name}"'] + [f'{k}="{v}"' for k, v in labels])
+                lines.append(f"{METRIC_PREFIX}span_errors_total{{{label_str}}} {count}")
+        return "\n".join(lines) + "\n"
+
+
+def format_summary(spans: dict):
+    # Linie "nazwa: liczba × średnia / p95 / max ms" do komendy /stats
+    lines = []
+    for name, stats in spans.items():
+        if not stats["count"]:
+            continue
+        lines.append(f"{name}: {stats['count']}× {stats['mean'] * 1000:.1f} / "
+                     f"{stats['p95'] * 1000:.1f} / {stats['max'] * 1000:.1f} ms")
+    return lines
+
+
+class MetricsServer:
+    # Lokalny endpoint /metrics w formacie tekstowym Prometheusa (METRICS_PORT=0 = wyłączony)
+    def __init__(self, metrics, host: str = METRICS_HOST, port: int = METRICS_PORT):
+        self.metrics = metrics
+        self.host = host
+        self.port = port
+        self._server = None
+
+    async def start(self):
+        if self.port <= 0 or self._server is not None:
+            return
+        self._server = await asyncio.start_server(self._handle, self.host, self.port)
+        print(f"[Info] Metrics available at http://{self.host}:{self.port}/metrics")
+
+    async def _handle(self, reader, writer):
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while True:
+                line = await asyncio.wait_for(reader.readline(), 5)
+                if line in (b"\r\n", b"\n", b""):
+                    break
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1].split("?", 1)[0] == "/metrics":
+                status, body = "200 OK", self.metrics.render_prometheus().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode("latin-1") + body
+            )
+            await writer.drain()
+        except (OSError, asyncio.TimeoutError):
+            pass
+        finally:
+            writer.close()
+
+    async def close(self):
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+            self._server = None
+
+
+METRICS = Metrics()
+METRICS_SERVER = MetricsServer(METRICS)
@@ -0,0 +1,155 @@
+import time
+import heapq
+import asyncio
+import itertools
+
+from telegram.error import RetryAfter
+
+from config import OUTBOX_RATE, OUTBOX_CONCURRENCY, OUTBOX_MAX_PENDING
+from metrics import METRICS
+
+# Mniejsza liczba = wyższy priorytet
+PRIORITY_RESULT = 0     # wynik odblokowania, koniec cyklu
+PRIORITY_PROGRESS = 1   # postęp bieżącego cyklu
+PRIORITY_CHATTER = 2    # powiadomienia informacyjne (np. wznowienie po restarcie)
+
+MAX_RETRIES = 3
+
+
+class OutboxItem:
+    def __init__(self, priority: int, seq: int, send, key, description: str):
+        self.priority = priority
+        self.seq = seq
+        self.send = send        # funkcja bez argumentów zwracająca korutynę wysyłki
+        self.key = key          # ta sama wiadomość w kolejce tylko raz
+        self.description = description
+        self.retries = 0
+        self.alive = True
+        self.submitted_at = time.monotonic()
+
+    def __lt__(self, other):
+        return (self.priority, self.seq) < (other.priority, other.seq)
+
+
+class Outbox:
+    # Wiadomości do Telegrama wysyłane w tle z limitem tempa; kod z terminem (strzał o 00:00)
+    # tylko wrzuca do kolejki i nigdy nie czeka na Telegram ani na flood-wait
+    def __init__(self, rate: float = OUTBOX_RATE, concurrency: int = OUTBOX_CONCURRENCY,
+                 max_pending: int = OUTBOX_MAX_PENDING):
+        self.rate = rate
+        self.concurrency = concurrency
+        self.max_pending = max_pending
+        self._heap = []
+        self._keys = {}          # key -> OutboxItem w kolejce
+        self._pending = 0
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._in_flight = None
+        self._next_slot = 0.0    # time.monotonic() najbliższej dozwolonej wysyłki
+        self.dropped = 0
+
+    def pending(self):
+        return self._pending
+
+    def submit(self, send, priority: int = PRIORITY_PROGRESS, key=None, description: str = ""):
+        queued = self._keys.get(key) if key is not None else None
+        if queued is not None:
+            if queued.priority <= priority:
+                return  # już czeka, wyśle aktualny stan
+            self._discard(queued)  # awans: np. postęp, który stał się wynikiem
+
+        item = OutboxItem(priority, next(self._seq), send, key, description)
+        if self._pending >= self.max_pending and not self._make_room(item):
+            self.dropped += 1
+            print(f"[Warning] Outbox full, dropping {description or 'message'}")
+            return
+        self._push(item)
+
+    def _push(self, item: OutboxItem):
+        heapq.heappush(self._heap, item)
+        self._pending += 1
+        if item.key is not None:
+            self._keys[item.key] = item
+        self._ensure_running()
+        self._wakeup.set()
+
+    def _discard(self, item: OutboxItem):
+        item.alive = False
+        self._pending -= 1
+        if item.key is not None and self._keys.get(item.key) is item:
+            del self._keys[item.key]
+
+    def _make_room(self, item: OutboxItem):
+        # Wyrzucamy najnowszą wiadomość o najniższym priorytecie, jeśli jest mniej ważna od nowej
+        alive = [queued for queued in self._heap if queued.alive]
+        worst = max(alive, key=lambda queued: (queued.priority, queued.seq), default=None)
+        if worst is None or worst.priority <= item.priority:
+            return False
+        self._discard(worst)
+        self.dropped += 1
+        print(f"[Warning] Outbox full, dropping {worst.description or 'message'}")
+        return True
+
+    def _ensure_running(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+            self._in_flight = asyncio.Semaphore(self.concurrency)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def _run(self):
+        while True:
+            while self._heap and not self._heap[0].alive:
+                heapq.heappop(self._heap)
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            # Limit tempa (i pauza po RetryAfter) - czekamy przed zdjęciem z kolejki,
+            # żeby pilniejsza wiadomość dodana w międzyczasie poszła pierwsza
+            delay = self._next_slot - time.monotonic()
+            if delay > 0:
+                await asyncio.sleep(delay)
+                continue
+            await self._in_flight.acquire()
+
+            while self._heap and not self._heap[0].alive:
+                heapq.heappop(self._heap)
+            if not self._heap:
+                self._in_flight.release()
+                continue
+            item = heapq.heappop(self._heap)
+            self._discard(item)
+            self._next_slot = max(self._next_slot, time.monotonic()) + 1.0 / self.rate
+            asyncio.create_task(self._deliver(item))
+
+    async def _deliver(self, item: OutboxItem):
+        METRICS.observe("outbox_delay", time.monotonic() - item.submitted_at, (("priority", item.priority),))
+        try:
+            await item.send()
+        except RetryAfter as e:
+            retry_after = getattr(e.retry_after, "total_seconds", lambda: e.retry_after)()
+            # Flood-wait dotyczy całego bota - wstrzymujemy całą kolejkę
+            self._next_slot = max(self._next_slot, time.monotonic() + retry_after)
+            if item.retries < MAX_RETRIES:
+                print(f"[Warning] Telegram flood control, retrying {item.description or 'message'} in {retry_after} s")
+                self._retry(item)
+            else:
+                print(f"[Error] Giving up on {item.description or 'message'} after {MAX_RETRIES} flood-wait retries")
+        except Exception as e:
+            print(f"[Error] Outbox failed to send {item.description or 'message'}: {e}")
+        finally:
+            self._in_flight.release()
+
+    def _retry(self, item: OutboxItem):
+        if item.key is not None and item.key in self._keys:
+            return  # nowsza wersja tej wiadomości już czeka
+        retry = OutboxItem(item.priority, item.seq, item.send, item.key, item.description)
+        retry.retries = item.retries + 1
+        retry.submitted_at = item.submitted_at
+        self._push(retry)
+
+
+OUTBOX = Outbox()
@@ -0,0 +1,99 @@
+import asyncio
+import itertools
+
+from telegram.error import BadRequest, RetryAfter
+
+from config import STATUS_DEBOUNCE
+from outbox import OUTBOX, PRIORITY_RESULT, PRIORITY_PROGRESS
+from metrics import METRICS
+
+MAX_MESSAGE_LENGTH = 4096  # limit Telegrama na długość wiadomości
+
+_cycle_ids = itertools.count()
+
+
+class StatusCycle:
+    # Statusy jednego cyklu (noc auto unlock, jeden manual unlock) = jedna wiadomość
+    def __init__(self):
+        self.id = next(_cycle_ids)
+        self.lines = []
+        self.message_id = None
+        self.sent_text = None
+        self.submitted = False
+        self.lock = asyncio.Lock()
+
+    def render(self):
+        text = "\n".join(self.lines)
+        if len(text) <= MAX_MESSAGE_LENGTH:
+            return text
+        # Najnowsze statusy są ważniejsze - obcinamy początek
+        return "…" + text[-(MAX_MESSAGE_LENGTH - 1):]
+
+
+class StatusReporter:
+    # Jedna wiadomość postępu na użytkownika na cykl: pierwszy status wysyłany od razu, kolejne
+    # dopisywane przez edit_message_text dopiero z wynikiem (final) albo po STATUS_DEBOUNCE sekundach.
+    # Noc auto unlock to więc jedna wiadomość i jedna edycja. send() nigdy nie czeka na Telegram -
+    # wysyłką zajmuje się OUTBOX w tle.
+    def __init__(self, bot, chat_id: int, debounce: float = STATUS_DEBOUNCE):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.debounce = debounce
+        self.cycle = StatusCycle()
+        self._flush_task = None
+
+    async def send(self, msg: str, final: bool = False):
+        # final=True kolejkuje wysyłkę z priorytetem wyniku i zamyka cykl - następny status zacznie nową wiadomość
+        cycle = self.cycle
+        cycle.lines.append(msg)
+        if final:
+            if self._flush_task is not None:
+                self._flush_task.cancel()
+                self._flush_task = None
+            self._submit(cycle, PRIORITY_RESULT)
+            self.cycle = StatusCycle()
+        elif not cycle.submitted:
+            # Pierwszy status cyklu - użytkownik od razu widzi, że cykl ruszył
+            cycle.submitted = True
+            self._submit(cycle, PRIORITY_PROGRESS)
+        elif self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._submit_later(cycle))
+
+    async def _submit_later(self, cycle: StatusCycle):
+        await asyncio.sleep(self.debounce)
+        self._flush_task = None
+        self._submit(cycle, PRIORITY_PROGRESS)
+
+    def _submit(self, cycle: StatusCycle, priority: int):
+        OUTBOX.submit(
+            lambda: self.flush(cycle), priority,
+            key=("status", self.chat_id, cycle.id),
+            description=f"status for {self.chat_id}",
+        )
+
+    async def flush(self, cycle: StatusCycle):
+        async with cycle.lock:
+            text = cycle.render()
+            if not text or text == cycle.sent_text:
+                return
+            try:
+                if cycle.message_id is None:
+                    with METRICS.span("telegram_send", method="send_message"):
+                        message = await self.bot.send_message(chat_id=self.chat_id, text=text)
+                    cycle.message_id = message.message_id
+                else:
+                    with METRICS.span("telegram_send", method="edit_message_text"):
+                        await self.bot.edit_message_text(chat_id=self.chat_id, message_id=cycle.message_id, text=text)
+                cycle.sent_text = text
+            except RetryAfter:
+                raise  # OUTBOX wstrzyma kolejkę i ponowi
+            except BadRequest as e:
+                if "not modified" in str(e).lower():
+                    cycle.sent_text = text
+                    return
+                # Wiadomość usunięta albo nie do edycji - przy ponownej próbie zaczynamy nową
+                print(f"Status message for {self.chat_id} could not be edited ({e}), sending a new one")
+                cycle.message_id = None
+                message = await self.bot.send_message(chat_id=self.chat_id, text=text)
+                cycle.message_id = message.message_id
+                cycle.sent_text = text
@@ -0,0 +1,83 @@
+import json
+import asyncio
+import unittest
+
+from burst import Shot, fire_burst
+from http_session import Response
+from workers import is_definitive_unlock_response
+
+TARGET_DELAY = 0.05  # sekundy od startu testu do "00:00"
+
+
+def unlock_response(apply_result: int):
+    return Response(200, {}, json.dumps({"code": 0, "data": {"apply_result": apply_result}}).encode())
+
+
+class FakePrepared:
+    def __init__(self, response, delay: float):
+        self.response = response
+        self.delay = delay      # po ilu sekundach od wysłania przychodzi odpowiedź
+        self.sent_at = None
+        self.sent_perf = None
+
+
+class FakeTimer:
+    def __init__(self):
+        loop = asyncio.get_running_loop()
+        self.target = loop.time() + TARGET_DELAY
+
+    async def wait(self, lead: float = 0.0):
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(max(0.0, self.target - lead - loop.time()))
+        return 0.0
+
+
+class FakeSession:
+    def __init__(self):
+        self.sent = []
+
+    async def checkout(self):
+        return object()
+
+    def release(self, conn):
+        pass
+
+    def send(self, prepared, conn):
+        prepared.sent_perf = asyncio.get_running_loop().time()
+        self.sent.append(prepared)
+
+    async def read_response(self, prepared, conn):
+        await asyncio.sleep(prepared.delay)
+        return prepared.response
+
+
+class FireBurstTest(unittest.IsolatedAsyncioTestCase):
+    async def test_early_limit_reached_does_not_stop_the_burst(self):
+        # Strzał -20 ms trafia jeszcze w limit poprzedniego dnia (apply_result 3), strzał 0 ms zostaje przyjęty
+        responses = [unlock_response(3), unlock_response(1), unlock_response(1), unlock_response(1)]
+        shots = [
+            Shot(i, offset, FakePrepared(response, 0.005))
+            for i, (offset, response) in enumerate(zip((-0.020, 0.0, 0.015, 0.040), responses))
+        ]
+
+        session = FakeSession()
+        shots, winner = await fire_burst(session, FakeTimer(), shots, is_definitive_unlock_response)
+
+        self.assertEqual([shot.sent for shot in shots], [True, True, False, False])
+        self.assertIs(winner, shots[1])
+
+    async def test_accepted_shot_stops_the_burst(self):
+        responses = [unlock_response(1), unlock_response(1), unlock_response(1)]
+        shots = [
+            Shot(i, offset, FakePrepared(response, 0.005))
+            for i, (offset, response) in enumerate(zip((-0.020, 0.0, 0.015), responses))
+        ]
+
+        shots, winner = await fire_burst(FakeSession(), FakeTimer(), shots, is_definitive_unlock_response)
+
+        self.assertEqual([shot.sent for shot in shots], [True, False, False])
+        self.assertIs(winner, shots[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
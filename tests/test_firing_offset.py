@@ -0,0 +1,81 @@
+import unittest
+
+from firing_offset import FiringOffsets, MIN_LEARNED_SAMPLES
+
+SERVER = "161.117.96.161"
+PING_OFFSET = 0.005
+RTT_MS = 10.0
+
+
+class MemoryStore:
+    def __init__(self):
+        self.saved = {}
+
+    def load_server_offsets(self):
+        return []
+
+    def save_server_offset(self, server, firing_offset, samples, last_outcome):
+        self.saved[server] = (firing_offset, samples, last_outcome)
+
+
+def make_offsets(**kwargs):
+    options = dict(enabled=True, rate=0.3, step=0.01, bound=0.25)
+    options.update(kwargs)
+    return FiringOffsets(MemoryStore(), **options)
+
+
+class FiringOffsetsTest(unittest.TestCase):
+    def test_burst_center_is_stable_when_first_shot_is_accepted(self):
+        # Seria -20,0,15,40 ms, co noc przyjęty pierwszy (najwcześniejszy) strzał, wysłany 0,5 ms po planie
+        offsets = make_offsets()
+        for _ in range(15):
+            applied, _ = offsets.offset_for(SERVER, PING_OFFSET)
+            shift = -0.020 + 0.0005
+            offsets.learn(SERVER, [(applied + shift, shift, RTT_MS, 0, 1)], applied)
+
+        applied, learned = offsets.offset_for(SERVER, PING_OFFSET)
+        self.assertTrue(learned)
+        self.assertAlmostEqual(applied, PING_OFFSET, delta=0.002)
+
+    def test_fallback_until_enough_nights(self):
+        offsets = make_offsets()
+        for night in range(MIN_LEARNED_SAMPLES):
+            self.assertEqual(offsets.offset_for(SERVER, PING_OFFSET), (PING_OFFSET, False))
+            offsets.learn(SERVER, [(0.001, 0.0, RTT_MS, 0, 1)], PING_OFFSET)
+        self.assertTrue(offsets.offset_for(SERVER, PING_OFFSET)[1])
+
+    def test_limit_reached_moves_earlier_within_bound(self):
+        offsets = make_offsets(bound=0.012)
+        state = offsets.learn(SERVER, [(0.002, 0.0, RTT_MS, 0, 3)], PING_OFFSET)
+        self.assertAlmostEqual(state.firing_offset, 0.002 - 0.01)
+        self.assertEqual(state.last_outcome, "too late")
+
+        state = offsets.learn(SERVER, [(0.001, 0.0, RTT_MS, 0, 3)], PING_OFFSET)
+        self.assertEqual(state.firing_offset, -0.012)
+
+    def test_limit_reached_before_server_midnight_moves_later(self):
+        # Strzał dochodzi ~20 ms przed 00:00 serwera i trafia w limit poprzedniego dnia - to za wcześnie
+        offsets = make_offsets()
+        applied = -0.025
+        for _ in range(3):
+            state = offsets.learn(SERVER, [(applied, 0.0, RTT_MS, 0, 3)], applied)
+            self.assertEqual(state.last_outcome, "too early")
+            self.assertGreater(state.firing_offset, applied)
+            applied = state.firing_offset
+
+    def test_only_early_codes_move_later(self):
+        offsets = make_offsets(early_codes=frozenset({100004}))
+        self.assertIsNone(offsets.learn(SERVER, [(-0.015, 0.0, RTT_MS, 100001, None)], PING_OFFSET))
+
+        state = offsets.learn(SERVER, [(-0.015, 0.0, RTT_MS, 100004, None)], PING_OFFSET)
+        self.assertAlmostEqual(state.firing_offset, PING_OFFSET + 0.01)
+        self.assertEqual(state.last_outcome, "too early")
+
+    def test_undecided_night_is_ignored(self):
+        offsets = make_offsets()
+        self.assertIsNone(offsets.learn(SERVER, [(0.001, 0.0, RTT_MS, 0, 4), (0.002, 0.0, None, None, None)], PING_OFFSET))
+        self.assertEqual(offsets.snapshot(), [])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+import json
+import time
+
+from config import TOKEN_CACHE_TTL, MI_SERVER_DOMAIN
+from http_session import get_session
+from user_store import USER_STORE
+
+TOKEN_NAMES = ("new_bbs_serviceToken", "popRunToken")
+# Lekki endpoint wymagający zalogowania - zwraca code 0 dla ważnego tokenu
+TOKEN_PROBE_URL = f"https://{MI_SERVER_DOMAIN}/bbs/api/global/user/bl-switch/state"
+
+_memory_cache = {}  # user_id -> (tokens, fetched_at)
+
+
+def save_tokens(user_id: int, tokens: dict):
+    fetched_at = time.time()
+    bbs_token = tokens.get("new_bbs_serviceToken", "MISSING_TOKEN")
+    pop_token = tokens.get("popRunToken", "MISSING_TOKEN")
+    if not USER_STORE.save_tokens(user_id, bbs_token, pop_token, fetched_at):
+        print(f"[Error] User {user_id} is not registered, tokens not saved.")
+        return False
+    _memory_cache[user_id] = (dict(tokens), fetched_at)
+    print(f"[Info] Tokens saved for user {user_id}")
+    return True
+
+
+def load_tokens(user_id: int):
+    # Zwraca (tokens, fetched_at) albo None
+    if user_id in _memory_cache:
+        tokens, fetched_at = _memory_cache[user_id]
+        return dict(tokens), fetched_at
+
+    row = USER_STORE.load_tokens(user_id)
+    if row is None:
+        return None
+    bbs_token, pop_token, fetched_at = row
+    tokens = dict(zip(TOKEN_NAMES, (bbs_token, pop_token)))
+    _memory_cache[user_id] = (tokens, fetched_at or 0.0)
+    return dict(tokens), fetched_at or 0.0
+
+
+def invalidate_tokens(user_id: int):
+    _memory_cache.pop(user_id, None)
+    USER_STORE.clear_tokens(user_id)
+
+
+def is_token_missing(value):
+    return not value or value.startswith("MISSING")
+
+
+async def probe_tokens(tokens: dict):
+    headers = {
+        "Cookie": f"new_bbs_serviceToken={tokens['new_bbs_serviceToken']};versionCode=500411;versionName=5.4.11;",
+        "User-Agent": "okhttp/4.12.0",
+    }
+    response = await get_session(MI_SERVER_DOMAIN).make_request("GET", TOKEN_PROBE_URL, headers=headers)
+    if response is None:
+        return False
+    try:
+        data = json.loads(response.data.decode("utf-8"))
+    except Exception as e:
+        print(f"[Error] Token probe returned invalid JSON: {e}")
+        return False
+    return response.status == 200 and data.get("code") == 0
+
+
+async def get_cached_tokens(user_id: int):
+    cached = load_tokens(user_id)
+    if cached is None:
+        return None
+    tokens, fetched_at = cached
+
+    if any(is_token_missing(tokens.get(name)) for name in TOKEN_NAMES):
+        return None
+    age = time.time() - fetched_at
+    if age > TOKEN_CACHE_TTL:
+        print(f"[Info] Cached tokens for user {user_id} are stale ({age:.0f} s old)")
+        return None
+
+    if not await probe_tokens(tokens):
+        print(f"[Info] Cached tokens for user {user_id} were rejected by Xiaomi API")
+        invalidate_tokens(user_id)
+        return None
+    return tokens
@@ -0,0 +1,148 @@
+import os
+import sys
+import json
+import asyncio
+import itertools
+
+from config import TOKEN_WORKER_PROCESSES, TOKEN_JOB_TIMEOUT
+
+WORKER_SCRIPT = os.path.abspath(__file__)
+
+# Protokół: jedna linia JSON na zadanie przez stdin, jedna linia JSON z wynikiem przez stdout.
+# Logi procesu roboczego idą na stderr.
+
+
+class TokenJobError(Exception):
+    # Logowanie nie powiodło się, ale proces roboczy działa dalej
+    pass
+
+
+class TokenWorker:
+    def __init__(self, index: int):
+        self.index = index
+        self.process = None
+        self._job_ids = itertools.count()
+
+    def is_alive(self):
+        return self.process is not None and self.process.returncode is None
+
+    async def ensure_started(self):
+        if self.is_alive():
+            return
+        if self.process is not None:
+            print(f"[Warning] Token worker {self.index} exited with code {self.process.returncode}, restarting")
+        self.process = await asyncio.create_subprocess_exec(
+            sys.executable, WORKER_SCRIPT,
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            cwd=os.getcwd(),
+        )
+        print(f"[Info] Started token worker {self.index} (pid {self.process.pid})")
+
+    async def run(self, email: str, password: str, timeout: float):
+        await self.ensure_started()
+        job_id = next(self._job_ids)
+        job = json.dumps({"id": job_id, "email": email, "password": password})
+        self.process.stdin.write(job.encode("utf-8") + b"\n")
+        await self.process.stdin.drain()
+
+        line = await asyncio.wait_for(self.process.stdout.readline(), timeout)
+        if not line:
+            raise RuntimeError(f"Token worker {self.index} exited during job")
+        reply = json.loads(line)
+        if reply.get("id") != job_id:
+            raise RuntimeError(f"Token worker {self.index} answered job {reply.get('id')} instead of {job_id}")
+        if reply.get("error"):
+            raise TokenJobError(f"Token worker {self.index} failed: {reply['error']}")
+        return reply.get("tokens")
+
+    async def kill(self):
+        if self.is_alive():
+            self.process.kill()
+            await self.process.wait()
+
+    async def stop(self):
+        if not self.is_alive():
+            return
+        self.process.stdin.close()
+        try:
+            await asyncio.wait_for(self.process.wait(), 10)
+        except asyncio.TimeoutError:
+            await self.kill()
+
+
+class TokenWorkerPool:
+    # Logowania w przeglądarkach w osobnych procesach: nie konkurują z pętlą bota o GIL,
+    # a awaria przeglądarki zabija co najwyżej proces roboczy, który jest restartowany.
+    def __init__(self, size: int = TOKEN_WORKER_PROCESSES, timeout: float = TOKEN_JOB_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self._workers = []
+        self._free = None
+
+    def enabled(self):
+        return self.size > 0
+
+    def _free_workers(self):
+        if self._free is None:
+            self._workers = [TokenWorker(i) for i in range(self.size)]
+            self._free = asyncio.Queue()
+            for worker in self._workers:
+                self._free.put_nowait(worker)
+        return self._free
+
+    async def login(self, email: str, password: str):
+        queue = self._free_workers()
+        worker = await queue.get()
+        try:
+            return await worker.run(email, password, self.timeout)
+        except asyncio.TimeoutError:
+            print(f"[Error] Token worker {worker.index} timed out after {self.timeout:.0f} s, killing it")
+            await worker.kill()
+            raise
+        except TokenJobError:
+            raise
+        except BaseException:
+            # Stan protokołu nieznany (awaria, anulowanie w trakcie) - bezpieczniej zacząć od nowa
+            await worker.kill()
+            raise
+        finally:
+            queue.put_nowait(worker)
+
+    async def close(self):
+        for worker in self._workers:
+            await worker.stop()
+
+
+TOKEN_WORKERS = TokenWorkerPool()
+
+
+async def serve(protocol_out):
+    from workers import login_tokens
+    from browser_pool import BROWSER_POOL
+
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            line = await loop.run_in_executor(None, sys.stdin.readline)
+            if not line:
+                break
+            job = json.loads(line)
+            try:
+                reply = {"id": job["id"], "tokens": await login_tokens(job["email"], job["password"])}
+            except Exception as e:
+                reply = {"id": job["id"], "error": repr(e)}
+            protocol_out.write(json.dumps(reply) + "\n")
+            protocol_out.flush()
+    finally:
+        await BROWSER_POOL.close()
+
+
+def main():
+    protocol_out = sys.stdout
+    sys.stdout = sys.stderr  # print() z modułów bota nie może zepsuć protokołu
+    asyncio.run(serve(protocol_out))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,452 @@
+import time
+import heapq
+import asyncio
+import itertools
+from datetime import datetime, timedelta
+import pytz
+
+from config import (
+    MI_SERVER_DOMAIN, TOKEN_FETCH_WINDOW, TOKEN_FETCH_MARGIN, HTTP_WARMUP_LEAD,
+    CLOCK_SYNC_LEAD, UNLOCK_BURST_OFFSETS,
+)
+from workers import (
+    get_tokens,
+    generate_device_id,
+    prepare_unlock_request,
+    describe_unlock_response,
+    parse_unlock_response,
+    is_definitive_unlock_response,
+    report_unlock_response,
+    save_status,
+)
+from http_session import get_session
+from latency_probe import LATENCY_PROBE
+from clock_sync import CLOCK_SYNC
+from deadline_timer import DeadlineTimer
+from burst import Shot, checkout_connections, fire_burst
+from status_reporter import StatusReporter
+from metrics import METRICS
+from user_store import USER_STORE
+from firing_offset import FIRING_OFFSETS
+
+TZ_CHINA = pytz.timezone('Asia/Shanghai')
+FETCH_RETRY_DELAY = 30           # sekundy między próbami pobrania tokenów
+FIRE_CHECKOUT_LEAD = 1.0         # sekundy przed strzałem, gdy bierzemy połączenia z puli
+MAX_IDLE_WAIT = 60.0             # dispatcher budzi się co najmniej tak często
+
+# Fazy nocy (kolejność przy równym czasie nie ma znaczenia - czasy są rozłączne)
+PHASE_FETCH = "fetch"    # per użytkownik
+PHASE_PROBE = "probe"    # wspólne: pomiar opóźnień + zegar serwera
+PHASE_WARMUP = "warmup"  # wspólne: rozgrzanie połączeń, przygotowanie zapytań
+PHASE_FIRE = "fire"      # wspólne: strzał wszystkich użytkowników, potem raporty
+
+
+def next_midnight_china():
+    now_china = datetime.now(TZ_CHINA)
+    midnight_china = now_china.replace(hour=0, minute=0, second=0, microsecond=0)
+    if now_china >= midnight_china:
+        midnight_china += timedelta(days=1)
+    return midnight_china
+
+
+def fetch_start_offset(user_id: int):
+    # Rozkładamy starty użytkowników w pierwszej połowie okna, reszta zostaje na kolejkę i ponowienia
+    spread = (TOKEN_FETCH_WINDOW - TOKEN_FETCH_MARGIN) / 2
+    return (user_id % 1000) / 1000 * max(0, spread)
+
+
+class AutoUnlockUser:
+    def __init__(self, user_id: int, user_data: dict, bot):
+        self.user_id = user_id
+        self.email = user_data.get("email")
+        self.password = user_data.get("password")
+        self.bot = bot
+        self.tokens = None
+        self.shots = None
+        self.fetch_task = None
+        self.status = StatusReporter(bot, user_id)
+
+    def reset_for_night(self):
+        self.tokens = None
+        self.shots = None
+
+    async def send_status(self, msg: str, final: bool = False):
+        # Statusy jednej nocy trafiają do jednej, edytowanej wiadomości
+        await self.status.send(msg, final)
+
+
+class UnlockScheduler:
+    # Jeden dispatcher z kopcem terminów dla wszystkich użytkowników auto unlock.
+    # Koszt zależy od liczby faz nocy, nie od liczby użytkowników.
+    def __init__(self):
+        self.users = {}           # user_id -> AutoUnlockUser
+        self._heap = []           # (when, seq, phase, night_ts, user)
+        self._seq = itertools.count()
+        self._wakeup = None
+        self._task = None
+        self._phase_tasks = set()
+        self.midnight = None      # północ (CST), do której przygotowujemy bieżący cykl
+        self.target_time = None   # faktyczny moment strzału (00:00 serwera + kompensacja)
+        self.timer = None
+        self.fire_at = None       # termin fazy fire w kopcu; None = faza już ruszyła
+        self.clock_offset = 0.0   # pomiary z fazy probe bieżącej nocy (do zapisu wyników strzałów)
+        self.firing_offset = 0.0
+        self.server_rtts = {}
+
+    # --- publiczne API (używane przez bot.py) ---
+
+    async def start(self, user_id: int, user_data: dict, bot):
+        if user_id in self.users:
+            return "Auto unlock already running"
+
+        user = AutoUnlockUser(user_id, user_data, bot)
+        if not user.email or not user.password:
+            await user.send_status("Email or password missing. Cannot run auto unlock.", final=True)
+            save_status(user_id, "stopped")
+            return "Auto unlock not started"
+
+        # Zapisywanie statusu 'autounlock' podczas startu
+        save_status(user_id, "autounlock")
+        self.users[user_id] = user
+        self._ensure_running()
+        if self.midnight is None:
+            self._plan_night(next_midnight_china())
+        else:
+            self._schedule_fetch(user)
+        return "Auto unlock started"
+
+    def is_running(self, user_id: int):
+        return user_id in self.users
+
+    def stop(self, user_id: int):
+        user = self.users.pop(user_id, None)
+        if user is None:
+            return
+        if user.fetch_task is not None and not user.fetch_task.done():
+            user.fetch_task.cancel()
+        save_status(user_id, "stopped")
+        if not self.users:
+            self._shutdown()
+
+    # --- dispatcher ---
+
+    def _ensure_running(self):
+        if self._wakeup is None:
+            self._wakeup = asyncio.Event()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    def _shutdown(self):
+        self._heap.clear()
+        self.midnight = None
+        self.target_time = None
+        self.timer = None
+        self.fire_at = None
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        for task in list(self._phase_tasks):
+            task.cancel()
+
+    def _push(self, when: float, phase: str, user=None):
+        heapq.heappush(self._heap, (when, next(self._seq), phase, self.midnight.timestamp(), user))
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _schedule_fetch(self, user, when: float = None):
+        if when is None:
+            when = self.midnight.timestamp() - TOKEN_FETCH_WINDOW + fetch_start_offset(user.user_id)
+        self._push(max(when, time.time()), PHASE_FETCH, user)
+
+    def _plan_night(self, midnight):
+        self.midnight = midnight
+        self.target_time = None
+        self.timer = None
+        self.clock_offset = 0.0
+        self.firing_offset = 0.0
+        self.server_rtts = {}
+        midnight_ts = midnight.timestamp()
+        for user in self.users.values():
+            user.reset_for_night()
+            self._schedule_fetch(user)
+        self._push(midnight_ts - CLOCK_SYNC_LEAD, PHASE_PROBE)
+        self._push(midnight_ts - HTTP_WARMUP_LEAD, PHASE_WARMUP)
+        self._schedule_fire(midnight_ts)
+
+    def _schedule_fire(self, target_ts: float):
+        # Wcześniejszy wpis fire w kopcu staje się nieaktualny (patrz _run)
+        self.fire_at = target_ts + UNLOCK_BURST_OFFSETS[0] - FIRE_CHECKOUT_LEAD
+        self._push(self.fire_at, PHASE_FIRE)
+
+    async def _run(self):
+        while True:
+            if not self._heap:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            when, _, phase, night_ts, user = self._heap[0]
+            delay = when - time.time()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=min(delay, MAX_IDLE_WAIT))
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._heap)
+            if self.midnight is None or night_ts != self.midnight.timestamp():
+                continue  # termin z poprzedniego planu
+            if user is not None and self.users.get(user.user_id) is not user:
+                continue  # użytkownik zatrzymał auto unlock
+
+            if phase == PHASE_FETCH:
+                user.fetch_task = self._spawn(self._fetch_tokens(user))
+            elif phase == PHASE_PROBE:
+                self._spawn(self._probe())
+            elif phase == PHASE_WARMUP:
+                self._spawn(self._warm_up())
+            elif phase == PHASE_FIRE:
+                if when != self.fire_at:
+                    continue  # termin przeliczony po synchronizacji zegara
+                self.fire_at = None
+                self._spawn(self._fire())
+
+    def _spawn(self, coro):
+        task = asyncio.create_task(coro)
+        self._phase_tasks.add(task)
+        task.add_done_callback(self._phase_done)
+        return task
+
+    def _phase_done(self, task):
+        self._phase_tasks.discard(task)
+        if not task.cancelled() and task.exception() is not None:
+            print(f"[Error] Auto unlock phase failed: {task.exception()!r}")
+
+    async def _broadcast(self, msg: str, users=None):
+        users = list(self.users.values()) if users is None else users
+        await asyncio.gather(*(user.send_status(msg) for user in users))
+
+    # --- fazy ---
+
+    async def _fetch_tokens(self, user):
+        midnight_ts = self.midnight.timestamp()
+        # Pobieramy tokeny przez wspólny harmonogram (EDF, limit przeglądarek i pamięci)
+        await user.send_status("Fetching tokens for auto unlock...")
+        try:
+            tokens = await get_tokens(user.user_id, user.email, user.password,
+                                      deadline=midnight_ts - TOKEN_FETCH_MARGIN)
+        except Exception as e:
+            print(f"[Error] Token fetch for user {user.user_id} raised: {e!r}")
+            tokens = None
+
+        if self.users.get(user.user_id) is not user:
+            return
+        if self.midnight is None or self.midnight.timestamp() != midnight_ts:
+            # Pobieranie skończyło się już po strzale tej nocy - tokeny nie mogą trafić do kolejnej
+            await user.send_status("Tokens were not ready before 00:00, skipping tonight's unlock.", final=True)
+            return
+        if tokens:
+            user.tokens = tokens
+            await user.send_status("Tokens fetched successfully. Will attempt unlock at 00:00 China time.")
+        elif time.time() + FETCH_RETRY_DELAY < midnight_ts:
+            await user.send_status(f"Failed to fetch tokens, retrying in {FETCH_RETRY_DELAY} seconds...")
+            self._schedule_fetch(user, time.time() + FETCH_RETRY_DELAY)
+        else:
+            await user.send_status("Failed to fetch tokens before 00:00, skipping tonight's unlock.", final=True)
+
+    def _ensure_target(self, offset_seconds: float = 0.0, clock_offset: float = 0.0):
+        if self.timer is None:
+            self.target_time = self.midnight + timedelta(seconds=offset_seconds - clock_offset)
+            self.timer = DeadlineTimer(self.target_time.timestamp())
+        return self.timer
+
+    async def _probe(self):
+        # Pomiar opóźnień do serwerów Xiaomi - jeden wspólny dla wszystkich użytkowników,
+        # zapytanie pójdzie bezpośrednio na najszybszy adres (z zapasowymi w kolejności)
+        probe = await LATENCY_PROBE.get()
+        get_session(MI_SERVER_DOMAIN).pin_addresses(probe.tls_capable())
+        best = probe.best()
+        best_server = best.ip if best else None
+        best_ping = round(best.rtt_ms, 1) if best else None
+
+        if best_server is None:
+            await self._broadcast("Failed to ping Xiaomi servers. Using default server time offset 0.")
+            best_ping = 0
+
+        ping_offset = (best_ping / 2) / 1000 if best_ping else 0
+        self.server_rtts = {server.ip: server.rtt_ms for server in probe.ranked()}
+        await self._broadcast(f"Best Xiaomi server: {best_server} with avg ping {best_ping} ms.")
+        # Offset wyuczony z poprzednich nocy dla tego serwera, a bez historii - połowa pingu
+        offset_seconds, learned = FIRING_OFFSETS.offset_for(best_server, ping_offset)
+        if learned:
+            await self._broadcast(f"Offsetting unlock time by {offset_seconds:+.3f} seconds "
+                                  f"(learned from previous nights, ping compensation would be {ping_offset:.3f}).")
+        else:
+            await self._broadcast(f"Offsetting unlock time by {offset_seconds:.3f} seconds for ping compensation.")
+
+        # Synchronizacja z zegarem serwera Xiaomi
+        clock = await CLOCK_SYNC.get()
+        clock_offset = clock.offset if clock else 0.0
+        if clock:
+            await self._broadcast(
+                f"Xiaomi server clock offset: {clock_offset * 1000:+.1f} ms (±{clock.uncertainty * 1000:.1f} ms)."
+            )
+
+        # Dokładny czas 00:00 czasu serwera + offset, odliczany na zegarze monotonicznym
+        self.clock_offset = clock_offset
+        self.firing_offset = offset_seconds
+        self.timer = None
+        self._ensure_target(offset_seconds, clock_offset)
+        # Zegar Xiaomi może wyprzedzać nasz o więcej niż FIRE_CHECKOUT_LEAD - fire liczymy od faktycznego celu
+        if self.fire_at is not None:
+            self._schedule_fire(self.target_time.timestamp())
+
+    def _prepare_shots(self, session):
+        # Bajty zapytań przygotowane z wyprzedzeniem - o 00:00 zostaje tylko zapis do gniazda
+        for user in self.users.values():
+            if user.tokens and user.shots is None:
+                device_id = generate_device_id()
+                user.shots = [
+                    Shot(i, offset, prepare_unlock_request(session, user.tokens, device_id))
+                    for i, offset in enumerate(UNLOCK_BURST_OFFSETS)
+                ]
+
+    async def _warm_up(self):
+        timer = self._ensure_target()
+        # Rozgrzewamy wspólne połączenia TLS chwilę przed strzałem (jedno na każdy strzał serii)
+        session = get_session(MI_SERVER_DOMAIN)
+        await session.keep_warm(len(self.users) * len(UNLOCK_BURST_OFFSETS), self.target_time.timestamp())
+        self._prepare_shots(session)
+
+        time_until_target = timer.remaining()
+        ready = [user for user in self.users.values() if user.shots is not None]
+        await self._broadcast(f"Waiting {time_until_target:.2f} seconds until exact unlock time (00:00)...", ready)
+
+    async def _fire(self):
+        finished_night = self.midnight
+        night_probe = (self.clock_offset, self.firing_offset, self.server_rtts)
+        try:
+            timer = self._ensure_target()
+            session = get_session(MI_SERVER_DOMAIN)
+            self._prepare_shots(session)
+            users = [user for user in self.users.values() if user.shots is not None]
+
+            if timer.remaining() <= 0:
+                await self._broadcast("Unlock time passed, sending immediately.", users)
+            overshoot = await timer.wait(lead=FIRE_CHECKOUT_LEAD - UNLOCK_BURST_OFFSETS[0])
+            METRICS.observe("fire_wait_overshoot", overshoot)
+            with METRICS.span("fire_checkout"):
+                await asyncio.gather(*(checkout_connections(session, user.shots) for user in users))
+
+            results = await asyncio.gather(
+                *(fire_burst(session, timer, user.shots, is_definitive_unlock_response) for user in users),
+                return_exceptions=True,
+            )
+        finally:
+            # Kolejna noc jest planowana zawsze (także po błędzie strzału), raporty idą w tle.
+            # Po _shutdown (midnight = None) nic nie planujemy.
+            if self.midnight is finished_night:
+                self._plan_night(finished_night + timedelta(days=1))
+
+        await asyncio.gather(*(
+            self._report(user, result, timer)
+            for user, result in zip(users, results)
+        ))
+        self._save_night_summary(finished_night, users, results)
+        self._record_shots(finished_night, timer, users, results, *night_probe)
+
+    def _save_night_summary(self, night, users, results):
+        summary = {
+            "users": len(users),
+            "failed_bursts": sum(1 for result in results if isinstance(result, BaseException)),
+            "spans": METRICS.close_night(),
+        }
+        try:
+            USER_STORE.save_night_summary(night.strftime("%Y-%m-%d"), summary)
+        except Exception as e:
+            print(f"[Error] Failed to save night summary: {e!r}")
+
+    def _record_shots(self, night, timer, users, results, clock_offset, firing_offset, server_rtts):
+        # Zapisujemy każdy wysłany strzał i uczymy offset serwerów, do których poszły
+        midnight_ts = night.timestamp()
+        rows = []
+        outcomes = {}  # server -> [(send_delta, shift, rtt_ms, code, apply_result)]
+        for user, result in zip(users, results):
+            if isinstance(result, BaseException):
+                continue
+            shots, _ = result
+            for shot in shots:
+                if not shot.sent:
+                    continue
+                server = shot.conn.peer if shot.conn is not None else None
+                send_delta = shot.prepared.sent_at + clock_offset - midnight_ts
+                parsed = parse_unlock_response(shot.response) if shot.response is not None else None
+                code, apply_result = parsed if parsed is not None else (None, None)
+                rows.append((user.user_id, shot.index, server, shot.prepared.sent_at, send_delta,
+                             server_rtts.get(server), code, apply_result))
+                if server is not None:
+                    shift = shot.offset + (shot.timing_error(timer) or 0.0)  # faktyczna odległość od środka serii
+                    outcomes.setdefault(server, []).append(
+                        (send_delta, shift, server_rtts.get(server), code, apply_result)
+                    )
+
+        try:
+            USER_STORE.save_shots(night.strftime("%Y-%m-%d"), rows)
+            for server, server_outcomes in outcomes.items():
+                state = FIRING_OFFSETS.learn(server, server_outcomes, firing_offset)
+                if state is not None:
+                    print(f"[Info] Firing offset for {server}: {state.firing_offset * 1000:+.1f} ms "
+                          f"after {state.last_outcome} shot ({state.samples} nights)")
+        except Exception as e:
+            print(f"[Error] Failed to record shot outcomes: {e!r}")
+
+    async def _report(self, user, result, timer):
+        if isinstance(result, BaseException):
+            print(f"[Error] Unlock burst for user {user.user_id} failed: {result!r}")
+            await user.send_status("[ERROR] Failed to send unlock request.")
+            await user.send_status("Auto unlock cycle finished. Waiting for next day...", final=True)
+            return
+        shots, winner = result
+
+        report_lines = []
+        for shot in shots:
+            if not shot.sent:
+                report_lines.append(f"#{shot.index + 1} ({shot.offset * 1000:+.0f} ms): not sent" +
+                                    (f" ({shot.error})" if shot.error else ""))
+                continue
+            sent_at = datetime.fromtimestamp(shot.prepared.sent_at, TZ_CHINA).strftime("%H:%M:%S.%f")[:-3]
+            METRICS.observe("shot_timing_error", abs(shot.timing_error(timer)))
+            error_ms = shot.timing_error(timer) * 1000
+            outcome = describe_unlock_response(shot.response) if shot.response is not None else f"no response ({shot.error})"
+            print(f"[Info] Unlock shot #{shot.index + 1} for user {user.user_id} sent at {sent_at} CST "
+                  f"({error_ms:+.2f} ms vs planned): {outcome}")
+            report_lines.append(f"#{shot.index + 1} ({shot.offset * 1000:+.0f} ms) sent at {sent_at}, "
+                                f"{error_ms:+.2f} ms from plan: {outcome}")
+        await user.send_status("Unlock requests (China time):\n" + "\n".join(report_lines))
+
+        result_shot = winner or next((shot for shot in shots if shot.response is not None), None)
+        if result_shot is None:
+            await user.send_status("[ERROR] Failed to send unlock request.")
+        else:
+            if winner is not None and len(shots) > 1:
+                await user.send_status(f"Definitive answer came from request #{winner.index + 1}.")
+            await report_unlock_response(result_shot.response, user.send_status)
+
+        await user.send_status("Auto unlock cycle finished. Waiting for next day...", final=True)
+
+
+UNLOCK_SCHEDULER = UnlockScheduler()
+
+
+async def start_auto_unlock_for_user(user_id: int, user_data: dict, bot):
+    return await UNLOCK_SCHEDULER.start(user_id, user_data, bot)
+
+
+def is_auto_unlock_running(user_id: int):
+    return UNLOCK_SCHEDULER.is_running(user_id)
+
+
+def stop_auto_unlock(user_id: int):
+    UNLOCK_SCHEDULER.stop(user_id)
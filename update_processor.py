@@ -0,0 +1,55 @@
+import asyncio
+
+from telegram.ext import BaseUpdateProcessor
+
+from config import UPDATE_CONCURRENCY
+
+# Górna granica aktualizacji przyjętych do obsługi (także czekających na swoją kolej u tego samego użytkownika)
+MAX_PENDING_UPDATES = 1024
+
+
+def update_key(update):
+    # Aktualizacje jednego użytkownika (albo czatu) obsługujemy po kolei
+    user = getattr(update, "effective_user", None)
+    if user is not None:
+        return "user", user.id
+    chat = getattr(update, "effective_chat", None)
+    if chat is not None:
+        return "chat", chat.id
+    return None
+
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    # Różni użytkownicy równolegle (do UPDATE_CONCURRENCY handlerów naraz), jeden użytkownik po kolei,
+    # więc /setup (ConversationHandler) dalej widzi wiadomości w kolejności
+    def __init__(self, max_concurrent_updates: int = UPDATE_CONCURRENCY):
+        # Semafor klasy bazowej liczy też aktualizacje czekające na blokadę użytkownika,
+        # dlatego właściwy limit równoległych handlerów trzymamy osobno
+        super().__init__(max(MAX_PENDING_UPDATES, max_concurrent_updates))
+        self.handler_limit = max_concurrent_updates
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._user_locks = {}  # klucz -> [Lock, liczba aktualizacji w obsłudze lub w kolejce]
+
+    async def do_process_update(self, update, coroutine):
+        key = update_key(update)
+        if key is None:
+            async with self._running:
+                await coroutine
+            return
+
+        entry = self._user_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                async with self._running:
+                    await coroutine
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._user_locks[key]
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
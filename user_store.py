@@ -0,0 +1,269 @@
+import os
+import json
+import time
+import sqlite3
+import threading
+
+from config import DATA_DIR, USER_DB_PATH
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    user_id INTEGER PRIMARY KEY,
+    authorized_at REAL NOT NULL,
+    language TEXT,
+    email_enc TEXT,
+    password_enc TEXT,
+    status TEXT,
+    bbs_token TEXT,
+    pop_token TEXT,
+    tokens_fetched_at REAL
+);
+CREATE TABLE IF NOT EXISTS night_summaries (
+    night TEXT PRIMARY KEY,
+    recorded_at REAL NOT NULL,
+    summary TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shots (
+    night TEXT NOT NULL,
+    user_id INTEGER NOT NULL,
+    shot_index INTEGER NOT NULL,
+    server TEXT,
+    sent_at REAL,
+    send_delta REAL,
+    rtt_ms REAL,
+    code INTEGER,
+    apply_result INTEGER,
+    PRIMARY KEY (night, user_id, shot_index)
+);
+CREATE TABLE IF NOT EXISTS server_offsets (
+    server TEXT PRIMARY KEY,
+    firing_offset REAL NOT NULL,
+    samples INTEGER NOT NULL,
+    last_outcome TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+
+class UserStore:
+    # Autoryzacja, zaszyfrowane dane logowania, status i tokeny w jednej bazie SQLite (WAL)
+    def __init__(self, path: str = USER_DB_PATH, legacy_dir: str = DATA_DIR):
+        self.path = path
+        self.legacy_dir = legacy_dir
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _db(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.executescript(SCHEMA)
+            self._conn = conn
+            self._upgrade_schema()
+            self._migrate_legacy()
+        return self._conn
+
+    def _execute(self, sql: str, params=()):
+        with self._lock:
+            return self._db().execute(sql, params)
+
+    def _upgrade_schema(self):
+        # Kolumny dodane po utworzeniu bazy
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(users)")}
+        if "language" not in columns:
+            self._conn.execute("ALTER TABLE users ADD COLUMN language TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS users_status ON users (status)")
+
+    # --- migracja ze starego układu data/<user_id>/ ---
+
+    def _migrate_legacy(self):
+        conn = self._conn
+        if conn.execute("SELECT 1 FROM meta WHERE key = 'legacy_migrated'").fetchone():
+            return
+        migrated = 0
+        if os.path.isdir(self.legacy_dir):
+            conn.execute("BEGIN")
+            try:
+                for name in os.listdir(self.legacy_dir):
+                    user_dir = os.path.join(self.legacy_dir, name)
+                    if name.isdigit() and os.path.isdir(user_dir):
+                        conn.execute(
+                            "INSERT OR IGNORE INTO users (user_id, authorized_at, email_enc, password_enc, status, "
+                            "bbs_token, pop_token, tokens_fetched_at) VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                            (int(name), os.path.getmtime(user_dir), *read_legacy_user(user_dir)),
+                        )
+                        migrated += 1
+                conn.execute("INSERT INTO meta (key, value) VALUES ('legacy_migrated', ?)", (str(time.time()),))
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+        else:
+            conn.execute("INSERT INTO meta (key, value) VALUES ('legacy_migrated', ?)", (str(time.time()),))
+        if migrated:
+            print(f"[Info] Migrated {migrated} users from {self.legacy_dir}/ to {self.path}")
+
+    # --- autoryzacja ---
+
+    def authorize(self, user_id: int, language: str = None):
+        self._execute(
+            "INSERT INTO users (user_id, authorized_at, language) VALUES (?, ?, ?) "
+            "ON CONFLICT (user_id) DO UPDATE SET language = COALESCE(excluded.language, language)",
+            (user_id, time.time(), language),
+        )
+
+    def is_authorized(self, user_id: int):
+        return self._execute("SELECT 1 FROM users WHERE user_id = ?", (user_id,)).fetchone() is not None
+
+    def delete_user(self, user_id: int):
+        return self._execute("DELETE FROM users WHERE user_id = ?", (user_id,)).rowcount > 0
+
+    # --- dane logowania (zaszyfrowane Fernetem po stronie bota) ---
+
+    def save_credentials(self, user_id: int, email_enc: str, password_enc: str):
+        cursor = self._execute(
+            "UPDATE users SET email_enc = ?, password_enc = ? WHERE user_id = ?", (email_enc, password_enc, user_id)
+        )
+        return cursor.rowcount > 0
+
+    def load_credentials(self, user_id: int):
+        # Zwraca (email_enc, password_enc) albo None
+        row = self._execute("SELECT email_enc, password_enc FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        if row is None or not row[0] or not row[1]:
+            return None
+        return row
+
+    # --- status auto unlock ---
+
+    def set_status(self, user_id: int, status):
+        self._execute("UPDATE users SET status = ? WHERE user_id = ?", (status, user_id))
+
+    def get_status(self, user_id: int):
+        row = self._execute("SELECT status FROM users WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else None
+
+    def users_with_status(self, status: str):
+        # Zwraca listę (user_id, email_enc, password_enc, language) użytkowników o danym statusie
+        return self._execute(
+            "SELECT user_id, email_enc, password_enc, language FROM users WHERE status = ? ORDER BY user_id", (status,)
+        ).fetchall()
+
+    # --- tokeny ---
+
+    def save_tokens(self, user_id: int, bbs_token: str, pop_token: str, fetched_at: float):
+        cursor = self._execute(
+            "UPDATE users SET bbs_token = ?, pop_token = ?, tokens_fetched_at = ? WHERE user_id = ?",
+            (bbs_token, pop_token, fetched_at, user_id),
+        )
+        return cursor.rowcount > 0
+
+    def load_tokens(self, user_id: int):
+        # Zwraca (bbs_token, pop_token, fetched_at) albo None
+        row = self._execute(
+            "SELECT bbs_token, pop_token, tokens_fetched_at FROM users WHERE user_id = ?", (user_id,)
+        ).fetchone()
+        if row is None or row[0] is None or row[1] is None:
+            return None
+        return row
+
+    def clear_tokens(self, user_id: int):
+        self._execute(
+            "UPDATE users SET bbs_token = NULL, pop_token = NULL, tokens_fetched_at = NULL WHERE user_id = ?",
+            (user_id,),
+        )
+
+    # --- podsumowania nocy (metryki) ---
+
+    def save_night_summary(self, night: str, summary: dict):
+        self._execute(
+            "INSERT OR REPLACE INTO night_summaries (night, recorded_at, summary) VALUES (?, ?, ?)",
+            (night, time.time(), json.dumps(summary)),
+        )
+
+    def recent_night_summaries(self, limit: int = 7):
+        # Zwraca listę (night, summary) od najnowszej nocy
+        rows = self._execute(
+            "SELECT night, summary FROM night_summaries ORDER BY night DESC LIMIT ?", (limit,)
+        ).fetchall()
+        return [(night, json.loads(summary)) for night, summary in rows]
+
+    # --- wyniki strzałów i wyuczone offsety serwerów ---
+
+    def save_shots(self, night: str, shots: list):
+        # shots: (user_id, shot_index, server, sent_at, send_delta, rtt_ms, code, apply_result)
+        with self._lock:
+            self._db().executemany(
+                "INSERT OR REPLACE INTO shots (night, user_id, shot_index, server, sent_at, send_delta, rtt_ms, "
+                "code, apply_result) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                [(night, *shot) for shot in shots],
+            )
+
+    def delete_shots(self, user_id: int):
+        return self._execute("DELETE FROM shots WHERE user_id = ?", (user_id,)).rowcount
+
+    def shot_outcome_counts(self, since_night: str):
+        # Zwraca listę (server, code, apply_result, liczba strzałów) od danej nocy
+        return self._execute(
+            "SELECT server, code, apply_result, COUNT(*) FROM shots WHERE night >= ? "
+            "GROUP BY server, code, apply_result ORDER BY server, code, apply_result", (since_night,)
+        ).fetchall()
+
+    def save_server_offset(self, server: str, firing_offset: float, samples: int, last_outcome: str):
+        self._execute(
+            "INSERT OR REPLACE INTO server_offsets (server, firing_offset, samples, last_outcome, updated_at) "
+            "VALUES (?, ?, ?, ?, ?)",
+            (server, firing_offset, samples, last_outcome, time.time()),
+        )
+
+    def load_server_offsets(self):
+        # Zwraca listę (server, firing_offset, samples, last_outcome, updated_at)
+        return self._execute(
+            "SELECT server, firing_offset, samples, last_outcome, updated_at FROM server_offsets ORDER BY server"
+        ).fetchall()
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+
+def read_legacy_user(user_dir: str):
+    # Zwraca (email_enc, password_enc, status, bbs_token, pop_token, fetched_at) ze starych plików
+    email_enc = password_enc = status = bbs_token = pop_token = fetched_at = None
+    try:
+        with open(os.path.join(user_dir, "credentials.json"), "r", encoding="utf-8") as f:
+            data = json.load(f)
+        email_enc = data.get("email") or None
+        password_enc = data.get("password") or None
+    except (OSError, ValueError):
+        pass
+    try:
+        with open(os.path.join(user_dir, "status"), "r", encoding="utf-8") as f:
+            status = f.read().strip() or None
+    except OSError:
+        pass
+    token_file = os.path.join(user_dir, "token")
+    try:
+        with open(token_file, "r", encoding="utf-8") as f:
+            lines = [line.strip() for line in f.readlines()]
+        if len(lines) >= 2:
+            bbs_token, pop_token = lines[:2]
+            try:
+                fetched_at = float(lines[2])
+            except (IndexError, ValueError):
+                fetched_at = os.path.getmtime(token_file)
+    except OSError:
+        pass
+    return email_enc, password_enc, status, bbs_token, pop_token, fetched_at
+
+
+USER_STORE = UserStore()
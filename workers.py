@@ -4,22 +4,22 @@ import json
 import asyncio
 import random
 import hashlib
-import urllib3
-from datetime import datetime, timedelta
-import pytz
+from functools import partial
+
+from browser_pool import BROWSER_POOL
+from config import DATA_DIR, MI_SERVERS, MI_SERVER_DOMAIN, TOKEN_WAIT_TIMEOUT, TOKEN_POLL_INTERVAL
+from token_cache import save_tokens, get_cached_tokens
+from fetch_scheduler import TokenFetchScheduler
+from http_session import get_session
+from latency_probe import LATENCY_PROBE
+from token_workers import TOKEN_WORKERS
+from user_store import USER_STORE
+from status_reporter import StatusReporter
+from metrics import METRICS
 
-from icmplib import ping
-from playwright.sync_api import sync_playwright
-
-DATA_DIR = "data"
 if not os.path.exists(DATA_DIR):
     os.makedirs(DATA_DIR)
 
-RUNNING_AUTO_UNLOCKS = {}  # user_id -> asyncio.Task
-
-MI_SERVERS = ['161.117.96.161', '20.157.18.26']
-MI_SERVER_DOMAIN = 'sgp-api.buy.mi.com'
-
 
 def generate_device_id():
     random_data = f"{random.random()}-{time.time()}"
@@ -27,69 +27,90 @@ def generate_device_id():
     return device_id
 
 
-def save_tokens(user_id: int, tokens: dict):
-    user_dir = os.path.join(DATA_DIR, str(user_id))
-    if not os.path.exists(user_dir):
-        print(f"[Error] User directory {user_dir} does not exist.")
-        return False
-    token_file = os.path.join(user_dir, "token")
-    with open(token_file, "w", encoding="utf-8") as f:
-        f.write(tokens.get("new_bbs_serviceToken", "MISSING_TOKEN") + "\n")
-        f.write(tokens.get("popRunToken", "MISSING_TOKEN") + "\n")
-    print(f"[Info] Tokens saved for user {user_id} to {token_file}")
-    return True
+LOGIN_URL = "https://sgp-api.buy.mi.com/bbs/api/global/user/login-in?callbackurl=https%3A%2F%2Fc.mi.com%2Fglobal%2F"
+LOGIN_AUTH_PATH = "/pass/serviceLoginAuth2"  # POST formularza logowania na account.xiaomi.com
+
+
+def parse_login_auth(body: str):
+    # Odpowiedź paszportu Xiaomi ("&&&START&&&{json}"); zwraca opis błędu albo None, gdy logowanie przeszło
+    try:
+        data = json.loads(body.split("&&&START&&&", 1)[-1])
+    except ValueError:
+        return None
+    if not isinstance(data, dict):
+        return None
+    if data.get("code", 0) != 0:
+        return data.get("desc") or f"code {data.get('code')}"
+    if data.get("captchaUrl"):
+        return "captcha required"
+    if data.get("notificationUrl"):
+        return "additional verification required"
+    return None
+
+
+async def login_and_get_cookie(context, email: str, password: str, cookie_name: str):
+    # Odrzucone logowanie (złe hasło, captcha, weryfikacja) kończy czekanie od razu
+    failure = asyncio.get_running_loop().create_future()
+
+    async def check_login_response(response):
+        if LOGIN_AUTH_PATH not in response.url or failure.done():
+            return
+        try:
+            error = parse_login_auth(await response.text())
+        except Exception:
+            return
+        if error and not failure.done():
+            failure.set_result(error)
+
+    with METRICS.span("login_page", cookie=cookie_name):
+        page = await context.new_page()
+        page.on("response", check_login_response)
+        await page.goto(LOGIN_URL)
+        await page.wait_for_load_state("networkidle")
+        await page.fill('input[name="account"]', email)
+        await page.fill('input[name="password"]', password)
+        await page.click('button[type="submit"]')
+
+    # Kończymy gdy tylko ciasteczko się pojawi zamiast zawsze czekać 10 s
+    with METRICS.span("cookie_wait", cookie=cookie_name):
+        deadline = time.monotonic() + TOKEN_WAIT_TIMEOUT
+        while True:
+            for c in await context.cookies():
+                if c.get("name") == cookie_name:
+                    return c.get("value")
+            if failure.done():
+                print(f"[Error] Xiaomi login rejected while waiting for {cookie_name}: {failure.result()}")
+                return None
+            if time.monotonic() >= deadline:
+                print(f"[Error] {cookie_name} cookie did not appear within {TOKEN_WAIT_TIMEOUT:.1f} s")
+                return None
+            await asyncio.sleep(TOKEN_POLL_INTERVAL)
+
+
+async def login_tokens(email: str, password: str):
+    # Firefox (new_bbs_serviceToken) i Chromium (popRunToken) logują się równolegle
+    bbs_token, pop_token = await asyncio.gather(
+        BROWSER_POOL.run(
+            "firefox", partial(login_and_get_cookie, email=email, password=password, cookie_name="new_bbs_serviceToken")
+        ),
+        BROWSER_POOL.run(
+            "chromium", partial(login_and_get_cookie, email=email, password=password, cookie_name="popRunToken")
+        ),
+    )
+
+    return {
+        "new_bbs_serviceToken": bbs_token or "MISSING",
+        "popRunToken": pop_token or "MISSING"
+    }
 
 
 async def get_tokens_playwright(user_id: int, email: str, password: str):
-    LOGIN_URL = "https://sgp-api.buy.mi.com/bbs/api/global/user/login-in?callbackurl=https%3A%2F%2Fc.mi.com%2Fglobal%2F"
-    loop = asyncio.get_event_loop()
-
-    def run_sync():
-        with sync_playwright() as p:
-            # Firefox - new_bbs_serviceToken
-            browser_firefox = p.firefox.launch(headless=True)
-            context_firefox = browser_firefox.new_context()
-            page_firefox = context_firefox.new_page()
-            page_firefox.goto(LOGIN_URL)
-            page_firefox.wait_for_load_state("networkidle")
-            page_firefox.fill('input[name="account"]', email)
-            page_firefox.fill('input[name="password"]', password)
-            page_firefox.click('button[type="submit"]')
-            time.sleep(10)  # wait for token cookies
-            cookies_firefox = context_firefox.cookies()
-            browser_firefox.close()
-
-            bbs_token = None
-            for c in cookies_firefox:
-                if c.get("name") == "new_bbs_serviceToken":
-                    bbs_token = c.get("value")
-                    break
-
-            # Chromium - popRunToken
-            browser_chromium = p.chromium.launch(headless=True)
-            context_chromium = browser_chromium.new_context()
-            page_chromium = context_chromium.new_page()
-            page_chromium.goto(LOGIN_URL)
-            page_chromium.wait_for_load_state("networkidle")
-            page_chromium.fill('input[name="account"]', email)
-            page_chromium.fill('input[name="password"]', password)
-            page_chromium.click('button[type="submit"]')
-            time.sleep(10)  # wait for token cookies
-            cookies_chromium = context_chromium.cookies()
-            browser_chromium.close()
-
-            pop_token = None
-            for c in cookies_chromium:
-                if c.get("name") == "popRunToken":
-                    pop_token = c.get("value")
-                    break
-
-            return {
-                "new_bbs_serviceToken": bbs_token or "MISSING",
-                "popRunToken": pop_token or "MISSING"
-            }
-
-    tokens = await loop.run_in_executor(None, run_sync)
+    # Przeglądarki w procesach roboczych (TOKEN_WORKER_PROCESSES > 0) albo w procesie bota
+    with METRICS.span("token_fetch"):
+        if TOKEN_WORKERS.enabled():
+            tokens = await TOKEN_WORKERS.login(email, password)
+        else:
+            tokens = await login_tokens(email, password)
 
     saved = save_tokens(user_id, tokens)
     if not saved:
@@ -97,64 +118,43 @@ async def get_tokens_playwright(user_id: int, email: str, password: str):
     return tokens
 
 
+FETCH_SCHEDULER = TokenFetchScheduler(get_tokens_playwright)
+
+
+async def get_tokens(user_id: int, email: str, password: str, deadline: float = None):
+    # Najpierw zapisane tokeny (jeśli świeże i zaakceptowane przez API), dopiero potem przeglądarki
+    tokens = await get_cached_tokens(user_id)
+    if tokens:
+        print(f"[Info] Using cached tokens for user {user_id}")
+        return tokens
+    return await FETCH_SCHEDULER.fetch(user_id, email, password, deadline)
+
+
 # ---- Dodajemy funkcję testową do zwracania tokenów ----
 async def test_tokens(user_id: int, user_data: dict):
-    tokens = await get_tokens_playwright(user_id, user_data.get("email"), user_data.get("password"))
+    tokens = await get_tokens(user_id, user_data.get("email"), user_data.get("password"))
     return tokens
 
 
-class HTTP11Session:
-    def __init__(self):
-        self.http = urllib3.PoolManager(
-            maxsize=10,
-            retries=True,
-            timeout=urllib3.Timeout(connect=2.0, read=15.0),
-            headers={}
-        )
+UNLOCK_URL = f"https://{MI_SERVER_DOMAIN}/bbs/api/global/apply/bl-auth"
 
-    def make_request(self, method, url, headers=None, body=None):
-        try:
-            request_headers = {}
-            if headers:
-                request_headers.update(headers)
-            request_headers['Content-Type'] = 'application/json; charset=utf-8'
-
-            if method == 'POST':
-                if body is None:
-                    body = '{"is_retry":true}'.encode('utf-8')
-                request_headers['Content-Length'] = str(len(body))
-                request_headers['Accept-Encoding'] = 'gzip, deflate, br'
-                request_headers['User-Agent'] = 'okhttp/4.12.0'
-                request_headers['Connection'] = 'keep-alive'
-
-            response = self.http.request(
-                method,
-                url,
-                headers=request_headers,
-                body=body,
-                preload_content=False
-            )
-            return response
-        except Exception as e:
-            print(f"[ERROR] HTTP request failed: {e}")
-            return None
+
+def prepare_unlock_request(session, tokens: dict, device_id: str):
+    headers = {
+        "Cookie": f"new_bbs_serviceToken={tokens['new_bbs_serviceToken']};versionCode=500411;versionName=5.4.11;deviceId={device_id};"
+    }
+    return session.prepare("POST", UNLOCK_URL, headers=headers)
 
 
 async def send_unlock_request(tokens: dict, device_id: str, send_status_func):
-    session = HTTP11Session()
+    session = get_session(MI_SERVER_DOMAIN)
 
-    # Ping servers to pick best
-    best_server = None
-    best_ping = None
-    for srv in MI_SERVERS:
-        try:
-            res = ping(srv, count=1, timeout=2)
-            if res.is_alive:
-                if best_ping is None or res.avg_rtt < best_ping:
-                    best_ping = res.avg_rtt
-                    best_server = srv
-        except Exception:
-            continue
+    # Wspólny pomiar opóźnień (ICMP + TCP/TLS) zamiast blokującego pingu
+    probe = await LATENCY_PROBE.get()
+    session.pin_addresses(probe.tls_capable())
+    best = probe.best()
+    best_server = best.ip if best else None
+    best_ping = round(best.rtt_ms, 1) if best else None
 
     if best_server is None:
         await send_status_func("Failed to ping Xiaomi servers, using default server.")
@@ -162,16 +162,45 @@ async def send_unlock_request(tokens: dict, device_id: str, send_status_func):
 
     await send_status_func(f"Using Xiaomi server: {best_server} (avg ping: {best_ping} ms)")
 
-    url = f"https://{MI_SERVER_DOMAIN}/bbs/api/global/apply/bl-auth"
-    headers = {
-        "Cookie": f"new_bbs_serviceToken={tokens['new_bbs_serviceToken']};versionCode=500411;versionName=5.4.11;deviceId={device_id};"
-    }
-
-    response = session.make_request("POST", url, headers=headers)
+    prepared = prepare_unlock_request(session, tokens, device_id)
+    with METRICS.span("unlock_post"):
+        response = await session.send_prepared(prepared)
     if response is None:
         await send_status_func("[ERROR] Failed to send unlock request.")
         return False
 
+    return await report_unlock_response(response, send_status_func)
+
+
+def parse_unlock_response(response):
+    # Zwraca (code, apply_result) albo None, jeśli odpowiedź nie jest poprawnym JSON-em
+    try:
+        response_data = json.loads(response.data.decode('utf-8'))
+    except Exception:
+        return None
+    data = response_data.get("data") or {}
+    return response_data.get("code"), data.get("apply_result")
+
+
+def is_definitive_unlock_response(response):
+    # Serię przerywa tylko przyjęcie (1) albo blokada konta (4). apply_result 3 (limit wyczerpany)
+    # dostaje też strzał, który doszedł tuż przed 00:00 serwera (limit poprzedniego dnia) -
+    # kolejne strzały serii muszą wtedy nadal wyjść.
+    parsed = parse_unlock_response(response)
+    return parsed is not None and parsed[0] == 0 and parsed[1] in (1, 4)
+
+
+def describe_unlock_response(response):
+    parsed = parse_unlock_response(response)
+    if parsed is None:
+        return f"HTTP {response.status}, invalid JSON"
+    code, apply_result = parsed
+    if code == 0:
+        return f"apply_result {apply_result}"
+    return f"code {code}"
+
+
+async def report_unlock_response(response, send_status_func):
     try:
         response_data = json.loads(response.data.decode('utf-8'))
         code = response_data.get("code")
@@ -197,22 +226,22 @@ async def send_unlock_request(tokens: dict, device_id: str, send_status_func):
 
 
 async def manual_unlock(user_id: int, user_data: dict, bot):
-    async def send_status(msg: str):
-        try:
-            await bot.send_message(chat_id=user_id, text=msg)
-        except Exception as e:
-            print(f"Error sending status to {user_id}: {e}")
+    # Cały przebieg w jednej, edytowanej wiadomości
+    status = StatusReporter(bot, user_id)
+
+    async def send_status(msg: str, final: bool = False):
+        await status.send(msg, final)
 
     email = user_data.get("email")
     password = user_data.get("password")
     if not email or not password:
-        await send_status("Email or password missing. Please setup your credentials first.")
+        await send_status("Email or password missing. Please setup your credentials first.", final=True)
         return None
 
-    await send_status("Starting manual unlock: fetching fresh tokens...")
-    tokens = await get_tokens_playwright(user_id, email, password)
+    await send_status("Starting manual unlock: fetching tokens...")
+    tokens = await get_tokens(user_id, email, password)
     if not tokens:
-        await send_status("Failed to fetch tokens. Cannot proceed with unlock.")
+        await send_status("Failed to fetch tokens. Cannot proceed with unlock.", final=True)
         return None
 
     await send_status("Tokens fetched successfully. Attempting unlock...")
@@ -220,137 +249,13 @@ async def manual_unlock(user_id: int, user_data: dict, bot):
     device_id = generate_device_id()
     await send_unlock_request(tokens, device_id, send_status)
 
-    await send_status("Manual unlock process finished.")
+    await send_status("Manual unlock process finished.", final=True)
     return tokens
 
 
 def save_status(user_id: int, status: str):
-    user_dir = os.path.join(DATA_DIR, str(user_id))
-    if not os.path.exists(user_dir):
-        os.makedirs(user_dir)
-    status_file = os.path.join(user_dir, "status")
-    with open(status_file, "w", encoding="utf-8") as f:
-        f.write(status)
+    USER_STORE.set_status(user_id, status)
 
 
 def load_status(user_id: int):
-    status_file = os.path.join(DATA_DIR, str(user_id), "status")
-    if not os.path.exists(status_file):
-        return None
-    with open(status_file, "r", encoding="utf-8") as f:
-        return f.read().strip()
-
-
-async def auto_unlock(user_id: int, user_data: dict, bot):
-    async def send_status(msg: str):
-        try:
-            await bot.send_message(chat_id=user_id, text=msg)
-        except Exception as e:
-            print(f"Error sending status to {user_id}: {e}")
-
-    email = user_data.get("email")
-    password = user_data.get("password")
-    if not email or not password:
-        await send_status("Email or password missing. Cannot run auto unlock.")
-        return
-
-    # Zapisywanie statusu 'autounlock' podczas startu
-    save_status(user_id, "autounlock")
-
-    tz_china = pytz.timezone('Asia/Shanghai')
-    now_utc = datetime.utcnow().replace(tzinfo=pytz.utc)
-
-    # Obliczamy kolejną północ (00:00 następnego dnia, jeśli już po północy)
-    now_china = now_utc.astimezone(tz_china)
-    midnight_china = now_china.replace(hour=0, minute=0, second=0, microsecond=0)
-    if now_china >= midnight_china:
-        midnight_china += timedelta(days=1)
-
-    while True:
-        # Liczymy czas do pobrania tokenów (5 minut przed północą)
-        now_utc = datetime.utcnow().replace(tzinfo=pytz.utc)
-        now_china = now_utc.astimezone(tz_china)
-        seconds_until_midnight = (midnight_china - now_china).total_seconds()
-        seconds_until_token_fetch = seconds_until_midnight - 5 * 60
-
-        if seconds_until_token_fetch > 0:
-            # Nie wyświetlamy wiadomości o czekaniu, tylko śpimy
-            await asyncio.sleep(seconds_until_token_fetch)
-
-        # Pobieramy tokeny 5 minut przed północą
-        await send_status("Fetching fresh tokens for auto unlock...")
-        tokens = await get_tokens_playwright(user_id, email, password)
-        if not tokens:
-            await send_status("Failed to fetch tokens, retrying in 30 seconds...")
-            await asyncio.sleep(30)
-            continue
-        else:
-            await send_status("Tokens fetched successfully. Will attempt unlock in 5 minutes.")
-
-        # Ping serwera Xiaomi (1 minuta przed odblokowaniem)
-        best_server = None
-        best_ping = None
-        for srv in MI_SERVERS:
-            try:
-                res = ping(srv, count=3, timeout=2)
-                if res.is_alive:
-                    avg_ping = res.avg_rtt
-                    if best_ping is None or avg_ping < best_ping:
-                        best_ping = avg_ping
-                        best_server = srv
-            except Exception:
-                continue
-
-        if best_server is None:
-            await send_status("Failed to ping Xiaomi servers. Using default server time offset 0.")
-            best_ping = 0
-
-        offset_seconds = (best_ping / 2) / 1000 if best_ping else 0
-        await send_status(f"Best Xiaomi server: {best_server} with avg ping {best_ping} ms.")
-        await send_status(f"Offsetting unlock time by {offset_seconds:.3f} seconds for ping compensation.")
-
-        # Obliczamy dokładny czas do 00:00 + offset
-        now_utc = datetime.utcnow().replace(tzinfo=pytz.utc)
-        now_china = now_utc.astimezone(tz_china)
-        target_time = midnight_china + timedelta(seconds=offset_seconds)
-        time_until_target = (target_time - now_china).total_seconds()
-
-        if time_until_target > 0:
-            await send_status(f"Waiting {time_until_target:.2f} seconds until exact unlock time (00:00)...")
-            await asyncio.sleep(time_until_target)
-        else:
-            await send_status("Unlock time passed, sending immediately.")
-
-        device_id = generate_device_id()
-        await send_unlock_request(tokens, device_id, send_status)
-
-        # Ustawiamy midnight na kolejny dzień
-        midnight_china += timedelta(days=1)
-
-        await send_status("Auto unlock cycle finished. Waiting for next day...")
-
-
-async def start_auto_unlock_for_user(user_id: int, user_data: dict, bot):
-    if user_id in RUNNING_AUTO_UNLOCKS:
-        return "Auto unlock already running"
-
-    task = asyncio.create_task(auto_unlock(user_id, user_data, bot))
-    RUNNING_AUTO_UNLOCKS[user_id] = task
-
-    def done_callback(t):
-        RUNNING_AUTO_UNLOCKS.pop(user_id, None)
-        save_status(user_id, "stopped")  # status po zatrzymaniu
-
-    task.add_done_callback(done_callback)
-    return "Auto unlock started"
-
-
-def is_auto_unlock_running(user_id: int):
-    return user_id in RUNNING_AUTO_UNLOCKS
-
-
-def stop_auto_unlock(user_id: int):
-    task = RUNNING_AUTO_UNLOCKS.pop(user_id, None)
-    if task:
-        task.cancel()
-        save_status(user_id, "stopped")
+    return USER_STORE.get_status(user_id)